@@ -8,17 +8,36 @@ import Server from './pages/Server';
 import Settings from './pages/Settings';
 import MailPage from './pages/Mail';
 import UsersPage from './pages/Users';
-import { Device, AppSettings, User, Mail, Notification, InviteCode, UpdateConfig } from './types';
+import { Device, AppSettings, User, Mail, Notification, InviteCode, UpdateConfig, DeviceUpdate, ChartDataPoint } from './types';
 import { api } from './services/api';
 import { WifiOff, RefreshCw, Server as ServerIcon, Download, Clock, CheckCircle, Loader, FileCode, Package, Play, AlertTriangle, XCircle } from 'lucide-react';
 
+const HISTORY_POINTS = 50;
+
+// Merge a pushed device delta into the list, appending its samples to the chart history
+const applyDeviceUpdate = (devices: Device[], update: DeviceUpdate): Device[] => {
+  const { points = [], ...fields } = update;
+  const idx = devices.findIndex(d => d.id === update.id);
+  const prev = idx === -1 ? ({ history: { cpu: [], memory: [], network: [] } } as unknown as Device) : devices[idx];
+  const append = (series: ChartDataPoint[], col: 1 | 2 | 3) => [
+    ...series,
+    ...points.map(p => ({ time: new Date(p[0] * 1000).toLocaleTimeString('en-GB'), value: Math.round(p[col] * 100) / 100 }))
+  ].slice(-HISTORY_POINTS);
+  const next = { ...prev, ...fields, history: { cpu: append(prev.history.cpu, 1), memory: append(prev.history.memory, 2), network: append(prev.history.network, 3) } } as Device;
+  return idx === -1 ? [...devices, next] : devices.map((d, i) => (i === idx ? next : d));
+};
+
+const applyRecord = <T extends object>(list: T[], op: 'put' | 'del', item: T, key = 'id' as keyof T): T[] => {
+  if (op === 'del') return list.filter(x => x[key] !== item[key]);
+  return list.some(x => x[key] === item[key]) ? list.map(x => (x[key] === item[key] ? item : x)) : [...list, item];
+};
+
 const App: React.FC = () => {
   const [isLoading, setIsLoading] = useState(true);
   const [connectionError, setConnectionError] = useState(false);
   const [errorDetails, setErrorDetails] = useState('');
   const [apiUrl, setApiUrl] = useState(api.getBaseUrl().replace('/api', ''));
   const [devices, setDevices] = useState<Device[]>([]);
-  const [server, setServer] = useState<Device | any>(null);
   const [refreshRate, setRefreshRate] = useState(2000);
   const [language, setLanguage] = useState('en');
   const [settings, setSettings] = useState<AppSettings>({
@@ -69,25 +88,39 @@ const App: React.FC = () => {
 
   useEffect(() => { initSystem(); }, []);
 
-  const fetchTelemetry = async () => {
+  const server = devices.find(d => d.id.includes('server') || d.name.toLowerCase().includes('server'));
+
+  const fetchDirectory = async () => {
       if (!currentUser || connectionError) return;
       try {
-          const devList = await api.getDevices();
-          setDevices(devList);
-          const serverInstance = devList.find(d => d.id.includes('server') || d.name.toLowerCase().includes('server'));
-          if (serverInstance) setServer(serverInstance);
-          const userList = await api.getUsers();
-          setUsers(userList);
+          setUsers(await api.getUsers());
           if (currentUser.role === 'Owner') setInvites(await api.getInvites());
+      } catch (e) { console.error("Directory error", e); }
+  };
+
+  const fetchTelemetry = async () => {
+      if (!currentUser || connectionError) return;
+      try {
+          setDevices(await api.getDevices());
+          await fetchDirectory();
           setMails(await api.getMails(currentUser.id));
           setNotifications(await api.getNotifications(currentUser.id));
       } catch (e) { console.error("Polling error", e); }
   };
 
   useEffect(() => {
-    fetchTelemetry(); 
-    const interval = setInterval(fetchTelemetry, refreshRate);
-    return () => clearInterval(interval);
+    if (!currentUser || connectionError) return;
+    return api.subscribe(currentUser, {
+      onSnapshot: (snap) => {
+        setDevices(snap.devices); setMails(snap.mails); setNotifications(snap.notifications);
+        setUsers(snap.users); setInvites(snap.invites);
+      },
+      onDevice: (update) => setDevices(prev => applyDeviceUpdate(prev, update)),
+      onMail: (op, mail) => setMails(prev => applyRecord(prev, op, mail)),
+      onNotification: (op, notification) => setNotifications(prev => applyRecord(prev, op, notification)),
+      onUser: (op, user) => setUsers(prev => applyRecord(prev, op, user)),
+      onInvite: (op, invite) => setInvites(prev => applyRecord(prev, op, invite, 'code'))
+    }, refreshRate);
   }, [currentUser, refreshRate, connectionError]);
 
   useEffect(() => {
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import shutil
+import tempfile
+import threading
+import http.client
+
+# Load generator for the generated pimonitor_server.py. Runs the real Flask app in-process behind
+# waitress on a local port and drives it with simulated agents that speak the agent's wire format.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(values, pct):
+    if not values: return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 3)
+
+def rss_mb():
+    import psutil
+    return round(psutil.Process().memory_info().rss / (1024**2), 2)
+
+def build_scripts(workdir):
+    sys.path.insert(0, BASE_DIR)
+    import setup_server, setup_device
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        setup_server.generate_server_script(0)
+        setup_device.generate_agent_script("http://127.0.0.1:0")
+    finally: os.chdir(cwd)
+    sys.path.insert(0, workdir)
+    import pimonitor_server, pimonitor_device
+    return pimonitor_server, pimonitor_device
+
+def start_server(app, threads):
+    try:
+        from waitress import create_server
+        srv = create_server(app, host='127.0.0.1', port=0, threads=threads)
+        port = srv.effective_port
+        threading.Thread(target=srv.run, daemon=True).start()
+    except ImportError:
+        from werkzeug.serving import make_server
+        srv = make_server('127.0.0.1', 0, app, threaded=True)
+        port = srv.server_port
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return port
+
+class SimAgent:
+    def __init__(self, index, agent, mode, batch_size):
+        self.id, self.name, self.agent, self.mode, self.batch_size = f"sim-{index:05d}", f"sim-{index}", agent, mode, batch_size
+        self.hw = { "cpu": { "model": "ARMv8 Processor rev 3 (v8l)", "cores": 4, "threads": 4, "baseSpeed": "N/A", "architecture": "aarch64" },
+                    "memory": { "total": "3.7 GB", "type": "RAM", "speed": "N/A", "formFactor": "N/A" },
+                    "gpu": { "model": "N/A", "vram": "N/A", "driver": "N/A" },
+                    "storage": [{ "name": "/dev/mmcblk0p2", "model": "Generic", "size": "29.1 GB", "type": "ext4", "interface": "/", "usage": 41.0 }] }
+        self.procs = [{ "pid": 1000 + i, "name": f"app-{i}", "pm_id": i, "status": "online", "cpu": 0, "memory": 40.0, "uptime": "0s", "restarts": 0 } for i in range(4)]
+        self.sent_meta = False
+
+    def stats(self):
+        return { "cpuUsage": round(random.uniform(5, 60), 1), "memoryUsage": round(random.uniform(30, 70), 1), "memoryUsed": 1.5, "memoryTotal": 3.7,
+                 "temperature": 0, "networkIn": round(random.uniform(0, 200), 1), "networkOut": round(random.uniform(0, 50), 1), "diskUsage": 41.0 }
+
+    def request(self):
+        for p in self.procs: p['cpu'] = round(random.uniform(0, 20), 1)
+        if self.mode == 'json':
+            body = json.dumps({ "id": self.id, "name": self.name, "os": "Linux 6.1", "stats": self.stats(), "processes": self.procs, "hardware": self.hw }).encode()
+            return '/api/telemetry', body, 'application/json', 1
+        a = self.agent
+        meta = { "id": self.id, "name": self.name, "os": "Linux 6.1", "hardwareHash": a.content_hash(self.hw), "processHash": a.content_hash([[p.get(k) for k in a.PROC_META] for p in self.procs]), "heartbeatInterval": self.batch_size }
+        if not self.sent_meta: meta.update(hardware=self.hw, processes=self.procs); self.sent_meta = True
+        else: meta['processDelta'] = {str(i): [p.get(k) for k in a.PROC_NUMBERS] for i, p in enumerate(self.procs)}
+        now = time.time()
+        samples = [(now - (self.batch_size - i), self.stats()) for i in range(self.batch_size)]
+        return '/api/telemetry/batch', a.encode_batch(meta, samples), 'application/x-pimonitor-batch', self.batch_size
+
+def drive(port, agents, interval, stop, results):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    next_due = {a.id: time.monotonic() + random.uniform(0, interval) for a in agents}
+    while not stop.is_set():
+        now = time.monotonic()
+        for a in agents:
+            if next_due[a.id] > now: continue
+            next_due[a.id] += interval
+            path, body, ctype, count = a.request()
+            t0 = time.perf_counter()
+            try:
+                conn.request('POST', path, body=body, headers={'Content-Type': ctype})
+                r = conn.getresponse(); r.read()
+                ok = r.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close(); conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30); ok = False
+            results.append((time.perf_counter() - t0, count, ok))
+        time.sleep(max(0, min(next_due.values()) - time.monotonic()) if agents else 0.1)
+    conn.close()
+
+def measure_devices(port, samples):
+    conn, latencies, size = http.client.HTTPConnection('127.0.0.1', port, timeout=60), [], 0
+    for _ in range(samples):
+        t0 = time.perf_counter()
+        conn.request('GET', '/api/devices', headers={'Accept-Encoding': 'gzip'})
+        r = conn.getresponse(); size = len(r.read())
+        latencies.append(time.perf_counter() - t0)
+    conn.close()
+    return { "p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99), "bytes": size }
+
+def run_step(port, agents, args):
+    stop, results, workers = threading.Event(), [], min(args.workers, len(agents))
+    interval = (args.batch_size if args.mode == 'batch' else 1) / args.rate
+    threads = [threading.Thread(target=drive, args=(port, agents[i::workers], interval, stop, results), daemon=True) for i in range(workers)]
+    started = time.time()
+    for t in threads: t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads: t.join()
+    elapsed = time.time() - started
+    latencies = [r[0] for r in results]
+    return {
+        "requests": len(results), "errors": sum(1 for r in results if not r[2]),
+        "p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99),
+        "samples_per_sec": round(sum(r[1] for r in results if r[2]) / elapsed, 1),
+        "offered_samples_per_sec": round(len(agents) * args.rate, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pimonitor_server ingest and query paths with simulated agents")
+    parser.add_argument('--devices', default='10,100,500', help="comma separated fleet sizes, grown cumulatively")
+    parser.add_argument('--mode', choices=['json', 'batch'], default='batch')
+    parser.add_argument('--rate', type=float, default=1.0, help="samples per second per simulated agent")
+    parser.add_argument('--batch-size', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load per fleet size")
+    parser.add_argument('--workers', type=int, default=32, help="client threads driving the agents")
+    parser.add_argument('--threads', type=int, default=64, help="server threads")
+    parser.add_argument('--query-samples', type=int, default=20)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--keep', action='store_true', help="keep the temporary server directory (tsdb segments, journals) after the run")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pimonitor-bench-')
+    server = None
+    try:
+        server, agent = build_scripts(workdir)
+        port = start_server(server.app, args.threads)
+        baseline = rss_mb()
+        print(f"Server in {workdir} on port {port} | mode={args.mode} rate={args.rate}/s | baseline RSS {baseline} MB")
+
+        agents, steps = [], []
+        for size in [int(n) for n in args.devices.split(',') if n.strip()]:
+            agents += [SimAgent(i, agent, args.mode, args.batch_size) for i in range(len(agents), size)]
+            step = { "devices": len(agents), "telemetry": run_step(port, agents, args), "devices_get": measure_devices(port, args.query_samples) }
+            step["rss_mb"] = rss_mb()
+            step["rss_per_device_kb"] = round((step["rss_mb"] - baseline) * 1024 / len(agents), 1)
+            steps.append(step)
+            t = step["telemetry"]
+            print(f"{len(agents):>6} devices | ingest p50 {t['p50_ms']}ms p99 {t['p99_ms']}ms {t['samples_per_sec']}/{t['offered_samples_per_sec']} samples/s err {t['errors']} | /api/devices p50 {step['devices_get']['p50_ms']}ms | RSS {step['rss_mb']} MB")
+
+        report = {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(), "platform": platform.platform(),
+            "server_version": server.server_settings.get('localHash'), "params": vars(args), "steps": steps,
+            "note": "RSS is for the whole benchmark process (server and simulated agents)"
+        }
+        with open(args.out, 'w') as f: json.dump(report, f, indent=2)
+        print(f"Results written to {args.out}")
+    finally:
+        if args.keep: print(f"Server data kept in {workdir}")
+        else:
+            if server:
+                server.flush_collections()  # Nothing left for the atexit flush to write back into workdir
+                server.data_lock.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__": main()
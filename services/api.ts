@@ -1,6 +1,7 @@
-import { Device, User, InviteCode, Mail, Notification, UpdateConfig, AppSettings } from '../types';
+import { Device, User, InviteCode, Mail, Notification, UpdateConfig, AppSettings, DeviceUpdate, StreamSnapshot, DeviceHistory, FleetSummary, Rollout, RolloutOptions } from '../types';
 
 const STORAGE_KEY = 'pimonitor_api_url';
+const STREAM_RETRY_INTERVAL = 60000; // How often a polling dashboard tries the stream again
 
 const getInitialBaseUrl = () => {
   const stored = localStorage.getItem(STORAGE_KEY);
@@ -11,6 +12,20 @@ const getInitialBaseUrl = () => {
 
 let API_BASE = getInitialBaseUrl();
 
+// Incremental /devices polling: only devices changed after devicesVersion are downloaded
+let deviceCache = new Map<string, Device>();
+let devicesVersion = 0;
+let devicesEpoch = '';
+
+export interface StreamHandlers {
+  onSnapshot: (snapshot: StreamSnapshot) => void;
+  onDevice: (update: DeviceUpdate) => void;
+  onMail: (op: 'put' | 'del', mail: Mail) => void;
+  onNotification: (op: 'put' | 'del', notification: Notification) => void;
+  onUser: (op: 'put' | 'del', user: User) => void;
+  onInvite: (op: 'put' | 'del', invite: InviteCode) => void;
+}
+
 export const api = {
   setBaseUrl(url: string) {
     let cleanUrl = url.trim().replace(/\/$/, '');
@@ -70,8 +85,104 @@ export const api = {
   },
 
   async getDevices(): Promise<Device[]> {
-    const res = await fetch(`${API_BASE}/devices`);
+    const query = devicesEpoch ? `?since=${devicesVersion}&epoch=${devicesEpoch}` : '';
+    const res = await fetch(`${API_BASE}/devices${query}`);
+    if (res.status === 304) return Array.from(deviceCache.values());
     if (!res.ok) return [];
+    const changed: Device[] = await res.json();
+    const epoch = res.headers.get('X-Devices-Epoch') || '';
+    if (!epoch || epoch !== devicesEpoch) deviceCache = new Map();
+    changed.forEach(d => deviceCache.set(d.id, d));
+    devicesEpoch = epoch;
+    devicesVersion = Number(res.headers.get('X-Devices-Version')) || 0;
+    return Array.from(deviceCache.values());
+  },
+
+  // Opens the server-push stream; falls back to polling when EventSource or /stream is unavailable,
+  // and keeps retrying the stream so a dashboard is not stuck polling after a transient 503.
+  subscribe(user: User, handlers: StreamHandlers, pollInterval: number): () => void {
+    const userId = user.id;
+    let source: EventSource | null = null;
+    let timer: ReturnType<typeof setInterval> | null = null;
+    let retry: ReturnType<typeof setTimeout> | null = null;
+    let closed = false;
+
+    const poll = async () => {
+      try {
+        const [devices, mails, notifications, users, invites] = await Promise.all([
+          this.getDevices(), this.getMails(userId), this.getNotifications(userId), this.getUsers(),
+          user.role === 'Owner' ? this.getInvites() : Promise.resolve([])
+        ]);
+        if (!closed) handlers.onSnapshot({ devices, mails, notifications, users, invites });
+      } catch (e) { console.error("Polling error", e); }
+    };
+    const startPolling = () => {
+      if (closed || timer) return;
+      poll();
+      timer = setInterval(poll, pollInterval);
+    };
+    const stopPolling = () => {
+      if (timer) clearInterval(timer);
+      timer = null;
+    };
+
+    const connect = () => {
+      retry = null;
+      if (closed) return;
+      let received = false;
+      const es = new EventSource(`${API_BASE}/stream?userId=${encodeURIComponent(userId)}`);
+      source = es;
+      const on = (event: string, fn: (data: any) => void) => es.addEventListener(event, (e) => {
+        if (!received) { received = true; stopPolling(); }
+        fn(JSON.parse((e as MessageEvent).data));
+      });
+      on('snapshot', handlers.onSnapshot);
+      on('device', handlers.onDevice);
+      on('mail', (d) => handlers.onMail(d.op, d.item));
+      on('notifications', (d) => handlers.onNotification(d.op, d.item));
+      on('users', (d) => handlers.onUser(d.op, d.item));
+      on('invites', (d) => handlers.onInvite(d.op, d.item));
+      es.onerror = () => {
+        // The browser reconnects on its own unless the stream never opened or a reconnect was refused
+        // (older server, proxy without streaming, or 503 when the server is out of stream slots)
+        if (received && es.readyState !== EventSource.CLOSED) return;
+        es.close();
+        if (source === es) source = null;
+        startPolling();
+        if (!closed && !retry) retry = setTimeout(connect, STREAM_RETRY_INTERVAL);
+      };
+    };
+
+    if (typeof EventSource === 'undefined') startPolling();
+    else connect();
+
+    return () => {
+      closed = true;
+      source?.close();
+      stopPolling();
+      if (retry) clearTimeout(retry);
+    };
+  },
+
+  async getFleetSummary(top = 5): Promise<FleetSummary | null> {
+    const res = await fetch(`${API_BASE}/fleet/summary?top=${top}`);
+    if (!res.ok) return null;
+    return await res.json();
+  },
+
+  // One page of the device list, optionally projected to a subset of fields (e.g. ['id', 'name', 'stats'])
+  async getDevicesPage(offset: number, limit: number, fields?: string[]): Promise<{ devices: Partial<Device>[]; total: number }> {
+    const params = new URLSearchParams({ offset: String(offset), limit: String(limit) });
+    if (fields?.length) params.set('fields', fields.join(','));
+    const res = await fetch(`${API_BASE}/devices?${params}`);
+    if (!res.ok) return { devices: [], total: 0 };
+    return { devices: await res.json(), total: Number(res.headers.get('X-Total-Count')) || 0 };
+  },
+
+  async getDeviceHistory(deviceId: string, metrics: string[], from: number, to: number, points: number, mode: 'lttb' | 'minmax' = 'lttb'): Promise<DeviceHistory | null> {
+    const params = new URLSearchParams({ metric: metrics.join(','), from: String(from), to: String(to), points: String(Math.round(points)), mode });
+    const res = await fetch(`${API_BASE}/devices/${encodeURIComponent(deviceId)}/history?${params}`);
+    if (!res.ok) return null;
     return await res.json();
   },
 
@@ -149,8 +260,12 @@ export const api = {
       return await res.json();
   },
   
-  async triggerUpdate(): Promise<void> {
-      await fetch(`${API_BASE}/update/execute`, { method: 'POST' });
+  async triggerUpdate(mode: 'incremental' | 'full' = 'incremental'): Promise<void> {
+      await fetch(`${API_BASE}/update/execute`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ mode })
+      });
   },
 
   async triggerDeviceUpdate(deviceId: string): Promise<void> {
@@ -161,6 +276,28 @@ export const api = {
       });
   },
 
+  async getRollouts(): Promise<Rollout[]> {
+      const res = await fetch(`${API_BASE}/rollouts`);
+      if (!res.ok) return [];
+      return await res.json();
+  },
+
+  async createRollout(deviceIds: string[] | '*', options: RolloutOptions = {}): Promise<Rollout> {
+      const res = await fetch(`${API_BASE}/rollouts`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ deviceIds, ...options })
+      });
+      if (!res.ok) throw new Error(await res.text());
+      return await res.json();
+  },
+
+  async controlRollout(id: string, action: 'pause' | 'resume' | 'cancel'): Promise<Rollout> {
+      const res = await fetch(`${API_BASE}/rollouts/${id}/${action}`, { method: 'POST' });
+      if (!res.ok) throw new Error(await res.text());
+      return await res.json();
+  },
+
   async updateSettings(settings: Partial<UpdateConfig & AppSettings>): Promise<void> {
       await fetch(`${API_BASE}/settings`, {
           method: 'POST',
@@ -27,18 +27,140 @@ def test_connection(url):
 
 def generate_agent_script(server_url):
     endpoint = f"{server_url}/api/telemetry"
-    script = f"""import requests, psutil, time, json, platform, socket, subprocess, threading, os, sys
+    commands_url = f"{server_url}/api"
+    script = f"""import requests, psutil, time, json, platform, socket, subprocess, threading, os, sys, struct, zlib, hashlib, collections, urllib.parse, zipfile, io, py_compile, shutil, mmap
 
 API_ENDPOINT = "{endpoint}"
+BATCH_ENDPOINT = "{endpoint}/batch"
+BATCH_SIZE = 5
+COMMANDS_URL = "{commands_url}"
+COMMAND_WAIT = 25
+SERVER_URL = "{server_url}"
 DEVICE_NAME = socket.gethostname()
 DEVICE_ID = f"{{socket.gethostname()}}-{{platform.machine()}}"
 
+# zlib( b'PMB1' | u32 meta_len | meta json | u32 count | count * (f64 ts, 8 * f32 stats) )
+STAT_FIELDS = ('cpuUsage', 'memoryUsage', 'memoryUsed', 'memoryTotal', 'temperature', 'networkIn', 'networkOut', 'diskUsage')
+SAMPLE_STRUCT = struct.Struct('<d8f')
+batch_supported = True
+
+# Hardware and process metadata are only re-sent when their hash changes or the server asks for them
+PROC_META = ('pid', 'name', 'pm_id', 'status')
+PROC_NUMBERS = ('cpu', 'memory', 'restarts', 'uptime')
+acked = {{ "hardware": None, "processes": None, "numbers": [] }}
+
+# Each collector runs on its own thread and cadence; the system collector stamps a sample every tick
+SAMPLE_INTERVAL = 1
+latest = {{}}
+samples = collections.deque(maxlen=600)
+batch_ready = threading.Event()
+net_state = {{ "at": None, "counters": None }}
+command_channel = {{ "active": False }}
+# Unacked commands are redelivered, so the outcome of recent ones is kept and acked again
+command_results, command_results_lock = collections.OrderedDict(), threading.Lock()
+COMMAND_RESULTS_MAX = 200
+
+# Processes are read with psutil: top-N by CPU and by RSS plus watched names (comma-separated PIMONITOR_WATCH).
+# pm2 is only asked for app names/ids/restarts when a managed pid exits or every PM2_INTERVAL seconds.
+PROCESS_INTERVAL = 5
+PROCESS_TOP_N = int(os.environ.get('PIMONITOR_TOP_PROCESSES', '10'))
+WATCH_PROCESSES = [n for n in os.environ.get('PIMONITOR_WATCH', '').split(',') if n]
+PM2_INTERVAL = 60
+PROC_ATTRS = ['name', 'create_time', 'status', 'memory_info']
+STOPPED_STATUSES = (psutil.STATUS_ZOMBIE, psutil.STATUS_STOPPED, psutil.STATUS_DEAD)
+
+# Updates arrive as a content-addressed bundle from the server; the digest of the installed one is the agent version
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_SCRIPT = os.path.join(AGENT_DIR, "pimonitor_device.py")
+VERSION_FILE = os.path.join(AGENT_DIR, "pimonitor_device.version")
+BUNDLE_PART = os.path.join(AGENT_DIR, "pimonitor_update.part")
+AGENT_VERSION = open(VERSION_FILE).read().strip() if os.path.exists(VERSION_FILE) else None
+
+# Samples that could not be delivered go to a fixed-size mmap ring of SAMPLE_STRUCT records (1 day at 1s).
+# Writes only dirty the touched pages and are left to kernel writeback, which keeps SD-card wear low.
+SPOOL_FILE = os.path.join(AGENT_DIR, "pimonitor_spool.bin")
+SPOOL_RECORDS = 86400
+SPOOL_HEADER = struct.Struct('<4sIIQ')  # magic, capacity, count, absolute index of the oldest record
+BACKFILL_BATCH = 300
+BACKFILL_INTERVAL = 2
+link_up = threading.Event()
+
 def execute_power_command(cmd):
     try:
         if platform.system() == 'Windows': os.system(f"shutdown /{{'r' if cmd=='reboot' else 's'}} /t 0")
         else: os.system(f"sudo {{'reboot' if cmd=='reboot' else 'shutdown -h now'}}")
     except: pass
 
+def ack_command(cmd, status, result=None):
+    try: requests.post(f"{{COMMANDS_URL}}/commands/{{cmd['id']}}/ack", json={{ "status": status, "result": result }}, timeout=5)
+    except: pass
+
+def download_bundle(args):
+    # Resumes a partial download with Range; If-Range makes the server resend in full if the bundle differs
+    offset = os.path.getsize(BUNDLE_PART) if os.path.exists(BUNDLE_PART) else 0
+    headers = {{ "Range": f"bytes={{offset}}-", "If-Range": f'"{{args["digest"]}}"' }} if offset else {{}}
+    with requests.get(SERVER_URL + args['path'], headers=headers, stream=True, timeout=30) as r:
+        if r.status_code not in (200, 206): raise IOError(f"Download failed: HTTP {{r.status_code}}")
+        with open(BUNDLE_PART, 'ab' if r.status_code == 206 else 'wb') as f:
+            for block in r.iter_content(1 << 16): f.write(block)
+    with open(BUNDLE_PART, 'rb') as f: body = f.read()
+    os.remove(BUNDLE_PART)
+    if hashlib.sha256(body).hexdigest() != args['digest']: raise IOError("Bundle digest mismatch")
+    return body
+
+def apply_update(args):
+    body = download_bundle(args)
+    staging = os.path.join(AGENT_DIR, "pimonitor_update")
+    shutil.rmtree(staging, ignore_errors=True)
+    with zipfile.ZipFile(io.BytesIO(body)) as z: z.extractall(staging)
+    try:
+        # A fresh interpreter imports the bundle's setup_device, never one cached by an earlier update
+        gen = subprocess.run([sys.executable, "-c", "import sys, setup_device; setup_device.generate_agent_script(sys.argv[1])", SERVER_URL],
+                             cwd=staging, capture_output=True, text=True, timeout=120)
+        if gen.returncode != 0: raise RuntimeError(f"Generator failed: {{(gen.stderr or '').strip()[-500:]}}")
+        py_compile.compile(os.path.join(staging, "pimonitor_device.py"), doraise=True)
+        shutil.copy2(os.path.join(staging, "pimonitor_device.py"), AGENT_SCRIPT + ".new")
+        os.replace(AGENT_SCRIPT + ".new", AGENT_SCRIPT)  # Atomic, so a failed copy leaves the running script in place
+    finally: shutil.rmtree(staging, ignore_errors=True)
+    with open(VERSION_FILE, 'w') as f: f.write(args['digest'])
+
+def finish_command(cmd, status, result=None):
+    with command_results_lock: command_results[cmd.get('id')] = (status, result)
+    ack_command(cmd, status, result)
+
+def handle_command(cmd):
+    action = cmd.get('action')
+    with command_results_lock:
+        outcome = command_results.get(cmd.get('id'))
+        if outcome is None:
+            command_results[cmd.get('id')] = ('running', None)
+            while len(command_results) > COMMAND_RESULTS_MAX: command_results.popitem(last=False)
+    if outcome is not None: ack_command(cmd, *outcome); return  # Our earlier ack was lost; 'running' stops further redelivery
+    if action == 'update' and (cmd.get('args') or {{}}).get('digest') == AGENT_VERSION: finish_command(cmd, 'done'); return
+    if action in ['reboot', 'shutdown']:
+        finish_command(cmd, 'done')
+        execute_power_command(action)
+    elif action == 'update':
+        try: apply_update(cmd.get('args') or {{}})
+        except Exception as e: finish_command(cmd, 'failed', str(e)); return
+        finish_command(cmd, 'done')
+        os.execv(sys.executable, [sys.executable, AGENT_SCRIPT])  # The server's health gate waits for the new agentVersion
+    else: finish_command(cmd, 'failed', f"Unsupported action {{action}}")
+
+def command_loop():
+    url = f"{{COMMANDS_URL}}/devices/{{urllib.parse.quote(DEVICE_ID, safe='')}}/commands"
+    while True:
+        try:
+            r = requests.get(url, params={{ "wait": COMMAND_WAIT }}, timeout=COMMAND_WAIT + 10)
+            if r.status_code != 200 or not r.headers.get('Content-Type', '').startswith('application/json'):
+                command_channel['active'] = False
+                return  # Older server: commands keep arriving with telemetry responses
+            command_channel['active'] = True
+            data = r.json()
+            for cmd in data.get('commands', []): handle_command(cmd)
+            if data.get('retryAfter'): time.sleep(data['retryAfter'])  # Server is out of long-poll slots
+        except: command_channel['active'] = False; time.sleep(5)
+
 def get_hardware_info():
     hw = {{
         "cpu": {{ "model": platform.processor(), "cores": psutil.cpu_count(), "threads": psutil.cpu_count(logical=True), "baseSpeed": "N/A", "architecture": platform.machine() }},
@@ -55,49 +177,479 @@ def get_hardware_info():
     except: pass
     return hw
 
-def get_pm2_stats():
-    try:
-        cmd = ['pm2', 'jlist']
-        res = subprocess.check_output(cmd, shell=True) if os.name == 'nt' else subprocess.check_output(cmd)
-        return [{{
-            "pid": p.get("pid"), "name": p.get("name"), "pm_id": p.get("pm_id"),
-            "status": p.get('pm2_env', {{}}).get('status', 'stopped'),
-            "cpu": p.get('monit', {{}}).get('cpu', 0),
-            "memory": round(p.get('monit', {{}}).get('memory', 0)/1024/1024, 1),
-            "uptime": "0s", "restarts": p.get('pm2_env', {{}}).get('restart_time', 0)
-        }} for p in json.loads(res)]
-    except: return []
+def format_uptime(seconds):
+    seconds = int(max(0, seconds))
+    units = [(seconds // 86400, 'd'), (seconds // 3600 % 24, 'h'), (seconds // 60 % 60, 'm'), (seconds % 60, 's')]
+    return ' '.join([f"{{n}}{{u}}" for n, u in units if n][:2]) or '0s'
+
+class ProcessCollector:
+    def __init__(self, top_n, watch, pm2_interval, on_pm2=None):
+        self.top_n, self.watch, self.pm2_interval, self.on_pm2 = top_n, set(watch), pm2_interval, on_pm2
+        self.cache, self.selected, self.pm2, self.pm2_at = {{}}, set(), {{}}, 0
+
+    def _refresh_pm2(self):
+        started = time.perf_counter()
+        try:
+            cmd = ['pm2', 'jlist']
+            res = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL) if os.name == 'nt' else subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+            self.pm2 = {{(p.get('name'), p.get('pm_id')): {{
+                "pid": p.get("pid") or 0, "pm_id": p.get("pm_id"),
+                "status": p.get('pm2_env', {{}}).get('status', 'stopped'),
+                "restarts": p.get('pm2_env', {{}}).get('restart_time', 0)
+            }} for p in json.loads(res)}}
+            if self.on_pm2: self.on_pm2(time.perf_counter() - started)
+        except (OSError, ValueError, subprocess.CalledProcessError): self.pm2 = {{}}  # No pm2 here
+        self.pm2_at = time.monotonic()
+
+    def collect(self):
+        rows, seen = {{}}, set()
+        for p in psutil.process_iter(PROC_ATTRS):
+            info, pid = p.info, p.pid
+            seen.add(pid)
+            cached = self.cache.get(pid)
+            if cached is None or cached[1] != info['create_time']: cached = self.cache[pid] = (p, info['create_time'])
+            try: cpu = cached[0].cpu_percent(None)  # Delta since this object's previous call; 0 on first sight
+            except psutil.Error: continue
+            rss = info['memory_info'].rss if info['memory_info'] else 0
+            rows[pid] = {{ "pid": pid, "name": info['name'] or str(pid), "pm_id": -1, "cpu": round(cpu, 1), "memory": round(rss / 1024 / 1024, 1),
+                          "status": 'stopped' if info['status'] in STOPPED_STATUSES else 'online', "uptime": format_uptime(time.time() - (info['create_time'] or time.time())), "restarts": 0 }}
+        for pid in list(self.cache):
+            if pid not in seen: del self.cache[pid]
+        # pm2 jlist spawns Node, so it only runs when a pm2-managed pid went away or on its slow cadence
+        if time.monotonic() - self.pm2_at >= self.pm2_interval or any(a['pid'] and a['pid'] not in seen for a in self.pm2.values()): self._refresh_pm2()
+        by_cpu = sorted(rows, key=lambda pid: (-rows[pid]['cpu'], pid))
+        by_rss = sorted(rows, key=lambda pid: (-rows[pid]['memory'], pid))
+        # Keep earlier picks while they stay within 2N so near-idle processes don't churn the list (and its hash)
+        keep = self.selected & set(by_cpu[:2 * self.top_n] + by_rss[:2 * self.top_n])
+        picked = set(by_cpu[:self.top_n]) | set(by_rss[:self.top_n]) | keep | {{pid for pid, r in rows.items() if r['name'] in self.watch}}
+        out = []
+        for (name, pm_id), app in self.pm2.items():
+            row = rows.get(app['pid']) if app['pid'] else None
+            if row is None: row = {{ "pid": 0, "name": name, "cpu": 0, "memory": 0, "uptime": "0s" }}
+            else: picked.discard(app['pid']); row = dict(row, name=name)
+            out.append(dict(row, pm_id=pm_id, status=app['status'], restarts=app['restarts']))
+        self.selected = picked
+        out += [rows[pid] for pid in picked]
+        running = {{r['name'] for r in out}}
+        out += [{{ "pid": 0, "name": name, "pm_id": -1, "cpu": 0, "memory": 0, "status": 'stopped', "uptime": "0s", "restarts": 0 }} for name in self.watch - running]
+        out.sort(key=lambda r: (r['pm_id'] < 0, r['name'], r['pid']))  # Stable order so processDelta indexes line up
+        return out
+
+process_collector = ProcessCollector(PROCESS_TOP_N, WATCH_PROCESSES, PM2_INTERVAL)
+
+def collect_network():
+    now, c = time.monotonic(), psutil.net_io_counters()
+    prev_at, prev = net_state['at'], net_state['counters']
+    net_state['at'], net_state['counters'] = now, c
+    if prev is None: return {{ "networkIn": 0, "networkOut": 0 }}
+    dt = max(now - prev_at, 1e-3)
+    return {{ "networkIn": round((c.bytes_recv-prev.bytes_recv)/1024/dt, 1), "networkOut": round((c.bytes_sent-prev.bytes_sent)/1024/dt, 1) }}
+
+def collect_disk():
+    return {{ "diskUsage": psutil.disk_usage('/').percent }}
+
+def collect_system():
+    mem = psutil.virtual_memory()
+    stats = {{ "cpuUsage": psutil.cpu_percent(), "memoryUsage": mem.percent, "memoryUsed": round((mem.total-mem.available)/(1024**3), 2), "memoryTotal": round(mem.total/(1024**3), 2), "temperature": 0 }}
+    stats.update(latest.get('network', {{}})); stats.update(latest.get('disk', {{}}))
+    samples.append((time.time(), stats))
+    if len(samples) >= BATCH_SIZE: batch_ready.set()
+    return stats
+
+COLLECTORS = [('network', 1, collect_network), ('disk', 30, collect_disk), ('processes', PROCESS_INTERVAL, process_collector.collect), ('system', SAMPLE_INTERVAL, collect_system)]
+
+def run_collector(name, interval, fn):
+    next_run = time.monotonic()
+    while True:
+        try: latest[name] = fn()
+        except: pass
+        next_run += interval
+        delay = next_run - time.monotonic()
+        if delay < 0: next_run, delay = time.monotonic(), 0  # Overran: skip missed ticks instead of bursting
+        time.sleep(delay)
+
+class Spool:
+    def __init__(self, path, capacity):
+        size = SPOOL_HEADER.size + capacity * SAMPLE_STRUCT.size
+        with open(path, 'a+b') as f:
+            if os.path.getsize(path) != size: f.truncate(0); f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        magic, cap, count, start = SPOOL_HEADER.unpack_from(self.map, 0)
+        if magic != b'PMS1' or cap != capacity: count, start = 0, 0
+        self.capacity, self.count, self.start, self.lock = capacity, count, start, threading.Lock()
+        self._sync()
+
+    def _sync(self): SPOOL_HEADER.pack_into(self.map, 0, b'PMS1', self.capacity, self.count, self.start)
+    def _offset(self, n): return SPOOL_HEADER.size + (n % self.capacity) * SAMPLE_STRUCT.size
+
+    def append(self, rows):
+        with self.lock:
+            for ts, s in rows:
+                SAMPLE_STRUCT.pack_into(self.map, self._offset(self.start + self.count), ts, *(float(s.get(k) or 0) for k in STAT_FIELDS))
+                if self.count < self.capacity: self.count += 1
+                else: self.start += 1  # Full: the oldest record was just overwritten
+            self._sync()
+
+    def peek(self, n):
+        with self.lock:
+            rows = [SAMPLE_STRUCT.unpack_from(self.map, self._offset(self.start + i)) for i in range(min(n, self.count))]
+            return [(row[0], dict(zip(STAT_FIELDS, row[1:]))) for row in rows], self.start + len(rows)
+
+    def drop(self, upto):
+        # upto is absolute, so records overwritten while a backfill was in flight are not dropped twice
+        with self.lock:
+            n = min(max(0, upto - self.start), self.count)
+            self.start += n; self.count -= n
+            self._sync()
+
+def backfill_loop(spool):
+    while True:
+        time.sleep(BACKFILL_INTERVAL)
+        if not spool.count or not link_up.is_set(): continue
+        if not batch_supported: spool.drop(spool.start + spool.count); continue  # The JSON endpoint cannot carry timestamps
+        rows, upto = spool.peek(BACKFILL_BATCH)
+        try:
+            meta = {{ "id": DEVICE_ID, "name": DEVICE_NAME, "backfill": True }}
+            r = requests.post(BATCH_ENDPOINT, data=encode_batch(meta, rows), headers={{'Content-Type': 'application/x-pimonitor-batch'}}, timeout=10)
+            if r.status_code == 200: spool.drop(upto)
+            else: link_up.clear()
+        except: link_up.clear()
+
+def encode_batch(meta, samples):
+    m = json.dumps(meta, separators=(',', ':')).encode()
+    rows = b''.join(SAMPLE_STRUCT.pack(ts, *(float(s.get(k) or 0) for k in STAT_FIELDS)) for ts, s in samples)
+    return zlib.compress(b'PMB1' + struct.pack('<I', len(m)) + m + struct.pack('<I', len(samples)) + rows, 6)
+
+def content_hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()).hexdigest()[:16]
+
+def build_meta(hw, procs):
+    hw_hash, proc_hash = content_hash(hw), content_hash([[p.get(k) for k in PROC_META] for p in procs])
+    numbers = [[p.get(k) for k in PROC_NUMBERS] for p in procs]
+    meta = {{ "id": DEVICE_ID, "name": DEVICE_NAME, "os": f"{{platform.system()}} {{platform.release()}}", "hardwareHash": hw_hash, "processHash": proc_hash, "heartbeatInterval": BATCH_SIZE * SAMPLE_INTERVAL, "commandChannel": command_channel['active'], "commandsInResponse": True, "agentVersion": AGENT_VERSION }}
+    if acked['hardware'] != hw_hash: meta['hardware'] = hw
+    if acked['processes'] != proc_hash: meta['processes'] = procs
+    else: meta['processDelta'] = {{str(i): n for i, (n, old) in enumerate(zip(numbers, acked['numbers'])) if n != old}}
+    return meta, (hw_hash, proc_hash, numbers)
+
+def ack_meta(need, hashes):
+    hw_hash, proc_hash, numbers = hashes
+    acked['hardware'] = None if 'hardware' in need else hw_hash
+    acked['processes'], acked['numbers'] = (None, []) if 'processes' in need else (proc_hash, numbers)
+
+def send_samples(meta, samples, hw, procs):
+    global batch_supported
+    meta = dict(meta, sentAt=time.time())  # Lets the server measure and undo this device's clock skew
+    if batch_supported:
+        r = requests.post(BATCH_ENDPOINT, data=encode_batch(meta, samples), headers={{'Content-Type': 'application/x-pimonitor-batch'}}, timeout=5)
+        if r.status_code != 404: return r
+        batch_supported = False  # Older server without the batch endpoint
+    return requests.post(API_ENDPOINT, json=dict(meta, stats=samples[-1][1], hardware=hw, processes=procs), timeout=5)
 
 def main():
     hw = get_hardware_info()
+    for name, interval, fn in COLLECTORS: threading.Thread(target=run_collector, args=(name, interval, fn), daemon=True).start()
+    threading.Thread(target=command_loop, daemon=True).start()
+    spool = Spool(SPOOL_FILE, SPOOL_RECORDS)
+    threading.Thread(target=backfill_loop, args=(spool,), daemon=True).start()
     while True:
+        batch_ready.wait(); batch_ready.clear()
+        batch = [samples.popleft() for _ in range(len(samples))]
+        if not batch: continue
         try:
-            mem = psutil.virtual_memory()
-            net1 = psutil.net_io_counters(); time.sleep(1); net2 = psutil.net_io_counters()
-            stats = {{
-                "cpuUsage": psutil.cpu_percent(), "memoryUsage": mem.percent, "memoryUsed": round((mem.total-mem.available)/(1024**3), 2), "memoryTotal": round(mem.total/(1024**3), 2),
-                "temperature": 0, "networkIn": round((net2.bytes_recv-net1.bytes_recv)/1024, 1), "networkOut": round((net2.bytes_sent-net1.bytes_sent)/1024, 1), "diskUsage": psutil.disk_usage('/').percent
-            }}
-            r = requests.post(API_ENDPOINT, json={{
-                "id": DEVICE_ID, "name": DEVICE_NAME, "os": f"{{platform.system()}} {{platform.release()}}",
-                "stats": stats, "processes": get_pm2_stats(), "hardware": hw
-            }}, timeout=5)
-            if r.status_code == 200:
-                cmd = r.json().get('command')
-                if cmd in ['reboot', 'shutdown']: execute_power_command(cmd)
-        except: pass
-        time.sleep(1)
+            procs = latest.get('processes', [])
+            meta, hashes = build_meta(hw, procs)
+            r = send_samples(meta, batch, hw, procs)
+            if r.status_code != 200: raise IOError(f"HTTP {{r.status_code}}")
+            link_up.set()
+            ack_meta(r.json().get('need', []) if batch_supported else ['hardware', 'processes'], hashes)
+            for cmd in r.json().get('commands', []): handle_command(cmd)
+            cmd = r.json().get('command')  # Older servers send a single action
+            if cmd in ['reboot', 'shutdown']: execute_power_command(cmd)
+        except:
+            link_up.clear()
+            spool.append(batch)
 
 if __name__ == "__main__": main()
 """
     with open("pimonitor_device.py", "w") as f: f.write(script)
     return "pimonitor_device.py"
 
+def generate_relay_script(upstream_url, port=3000):
+    script = f"""import requests, time, json, socket, threading, os, struct, zlib, hashlib, collections, shutil, urllib.parse, itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+UPSTREAM_URL = "{upstream_url}"
+RELAY_ENDPOINT = f"{{UPSTREAM_URL}}/api/telemetry/relay"
+PORT = {port}
+RELAY_NAME = socket.gethostname()
+FORWARD_INTERVAL = 10
+DOWNSAMPLE_STEP = 5
+CLOCK_SKEW_TOLERANCE = 2  # Agent samples are moved onto the relay's clock beyond this offset
+MAX_PENDING = 720  # Downsampled samples kept per device while the uplink is down (1h at 5s)
+MAX_BACKFILL = MAX_PENDING * 10
+# Once a device's queue is full the relay answers 503, so the agent keeps the samples in its own disk spool
+COMMAND_WAIT = 25
+RELAY_DIR = os.path.dirname(os.path.abspath(__file__))
+RELEASE_DIR = os.path.join(RELAY_DIR, "relay_releases")
+
+# Same per-device section as the central batch endpoint; the relay frame is zlib( b'PMR1' | u32 n | n * section )
+STAT_FIELDS = ('cpuUsage', 'memoryUsage', 'memoryUsed', 'memoryTotal', 'temperature', 'networkIn', 'networkOut', 'diskUsage')
+SAMPLE_STRUCT = struct.Struct('<d8f')
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+MAX_FRAME_BYTES = MAX_BATCH_BYTES // 2  # Uncompressed bytes per uplink POST; larger backlogs go up in several POSTs
+PROC_NUMBERS = ('cpu', 'memory', 'restarts', 'uptime')
+
+class SiteDevice:
+    def __init__(self, d_id):
+        self.id, self.meta, self.hardware, self.processes = d_id, {{}}, None, []
+        self.hashes = {{}}            # What the agent last sent us
+        self.upstream = {{}}          # Hashes (and process numbers) the central server has acknowledged
+        self.pending, self.backfill = collections.deque(), collections.deque()
+        self.base = {{'pending': 0, 'backfill': 0}}  # Absolute index of each queue's first row
+        self.raw, self.ip, self.clock = [], None, 0
+
+    def full(self, backfill, n):
+        if backfill: return len(self.backfill) + n > MAX_BACKFILL
+        return len(self.pending) >= MAX_PENDING or len(self.raw) + n > MAX_PENDING * DOWNSAMPLE_STEP
+
+class BufferFull(Exception): pass
+
+devices, devices_lock = {{}}, threading.Lock()
+command_queues, command_cond = {{}}, threading.Condition()
+release_lock = threading.Lock()
+
+def parse_section(buf, off):
+    (meta_len,) = struct.unpack_from('<I', buf, off)
+    meta = json.loads(buf[off + 4:off + 4 + meta_len])
+    (count,) = struct.unpack_from('<I', buf, off + 4 + meta_len)
+    start = off + 8 + meta_len
+    body = buf[start:start + count * SAMPLE_STRUCT.size]
+    if len(body) != count * SAMPLE_STRUCT.size: raise ValueError('Truncated batch')
+    return meta, [(row[0], dict(zip(STAT_FIELDS, row[1:]))) for row in SAMPLE_STRUCT.iter_unpack(body)], start + len(body)
+
+def encode_section(meta, samples):
+    m = json.dumps(meta, separators=(',', ':')).encode()
+    rows = b''.join(SAMPLE_STRUCT.pack(ts, *(float(s.get(k) or 0) for k in STAT_FIELDS)) for ts, s in samples)
+    return struct.pack('<I', len(m)) + m + struct.pack('<I', len(samples)) + rows
+
+def downsample(samples):
+    buckets = collections.OrderedDict()
+    for ts, s in sorted(samples, key=lambda x: x[0]): buckets.setdefault(int(ts // DOWNSAMPLE_STEP), []).append(s)
+    return [(b * DOWNSAMPLE_STEP, {{k: round(sum(float(s.get(k) or 0) for s in rows) / len(rows), 2) for k in STAT_FIELDS}}) for b, rows in buckets.items()]
+
+def accept(data, samples, ip):
+    # Mirrors the server's apply_delta so agents get the same 'need' answers from the relay
+    d_id, need = data['id'], []
+    with devices_lock:
+        dev = devices.get(d_id) or devices.setdefault(d_id, SiteDevice(d_id))
+        if dev.full(data.get('backfill'), len(samples)): raise BufferFull()
+        dev.ip = ip
+        if not data.get('backfill'):
+            ref = data.get('sentAt') or (samples[-1][0] if samples else None)
+            if ref: dev.clock = time.time() - ref
+        if abs(dev.clock) > CLOCK_SKEW_TOLERANCE: samples = [(ts + dev.clock, st) for ts, st in samples]
+        if data.get('backfill'): dev.backfill.extend(samples); return need
+        dev.meta.update({{k: data[k] for k in ('name', 'os', 'heartbeatInterval', 'agentVersion') if k in data}})
+        if 'hardware' in data: dev.hardware, dev.hashes['hardware'] = data['hardware'], data.get('hardwareHash')
+        elif data.get('hardwareHash') != dev.hashes.get('hardware'): need.append('hardware')
+        if 'processes' in data: dev.processes, dev.hashes['processes'] = data['processes'], data.get('processHash')
+        elif data.get('processHash') != dev.hashes.get('processes'): need.append('processes')
+        else:
+            try:
+                for i, nums in (data.get('processDelta') or {{}}).items(): dev.processes[int(i)].update(zip(PROC_NUMBERS, nums))
+            except (IndexError, ValueError, TypeError, AttributeError): dev.hashes['processes'] = None; need.append('processes')
+        dev.raw.extend(samples)
+    return need
+
+def upstream_meta(dev):
+    meta = dict(dev.meta, id=dev.id, ip=dev.ip, relay=RELAY_NAME, commandChannel=True,
+                hardwareHash=dev.hashes.get('hardware'), processHash=dev.hashes.get('processes'))
+    meta['heartbeatInterval'] = max(meta.get('heartbeatInterval') or 0, FORWARD_INTERVAL)
+    meta['sentAt'] = time.time()  # Samples are on the relay's clock now; the server corrects for the relay's own skew
+    numbers = [[p.get(k) for k in PROC_NUMBERS] for p in dev.processes]
+    if dev.upstream.get('hardware') != meta['hardwareHash'] and dev.hardware is not None: meta['hardware'] = dev.hardware
+    if dev.upstream.get('processes') != meta['processHash']: meta['processes'] = dev.processes
+    else: meta['processDelta'] = {{str(i): n for i, (n, old) in enumerate(zip(numbers, dev.upstream.get('numbers', []))) if n != old}}
+    return meta, numbers
+
+def forward():
+    sections = []
+    with devices_lock:
+        for dev in devices.values():
+            dev.pending.extend(downsample(dev.raw)); dev.raw = []
+            if dev.pending:
+                meta, numbers = upstream_meta(dev)
+                batch = list(dev.pending)
+                sections.append((encode_section(meta, batch), (dev, 'pending', dev.base['pending'] + len(batch), meta, numbers)))
+            if dev.backfill:
+                batch = list(itertools.islice(dev.backfill, MAX_PENDING))
+                sections.append((encode_section({{'id': dev.id, 'backfill': True}}, batch), (dev, 'backfill', dev.base['backfill'] + len(batch), None, None)))
+    frame, size = [], 8
+    for section in sections:
+        if frame and size + len(section[0]) > MAX_FRAME_BYTES: send_frame(frame); frame, size = [], 8
+        frame.append(section); size += len(section[0])
+    if frame: send_frame(frame)
+
+def send_frame(frame):
+    # One POST per frame, so a failure only keeps this frame's rows queued
+    body = zlib.compress(b'PMR1' + struct.pack('<I', len(frame)) + b''.join(data for data, _ in frame), 6)
+    r = requests.post(RELAY_ENDPOINT, data=body, headers={{'Content-Type': 'application/x-pimonitor-relay'}}, timeout=30)
+    r.raise_for_status()
+    results = r.json().get('devices', {{}})
+    with devices_lock:
+        for _, (dev, queue, upto, meta, numbers) in frame:
+            q = dev.pending if queue == 'pending' else dev.backfill
+            n = min(max(0, upto - dev.base[queue]), len(q))  # Rows appended during the POST sit behind upto
+            for _ in range(n): q.popleft()
+            dev.base[queue] += n
+            res = results.get(dev.id) or {{}}
+            if meta is None or 'error' in res: continue
+            need = res.get('need', [])
+            dev.upstream['hardware'] = None if 'hardware' in need else meta['hardwareHash']
+            dev.upstream['processes'], dev.upstream['numbers'] = (None, []) if 'processes' in need else (meta['processHash'], numbers)
+            if res.get('commands'):
+                with command_cond:
+                    command_queues.setdefault(dev.id, collections.deque()).extend(res['commands'])
+                    command_cond.notify_all()
+
+def forward_loop():
+    next_run = time.monotonic()
+    while True:
+        next_run += FORWARD_INTERVAL
+        time.sleep(max(0, next_run - time.monotonic()))
+        try: forward()
+        except Exception as e: print(f"Uplink error: {{e}}")  # Samples stay queued; full queues push back on the agents
+
+def take_commands(d_id, wait):
+    deadline = time.time() + wait
+    with command_cond:
+        while not command_queues.get(d_id):
+            remaining = deadline - time.time()
+            if remaining <= 0: return []
+            command_cond.wait(remaining)
+        q = command_queues.pop(d_id)
+        return list(q)
+
+def pop_command(d_id):
+    with command_cond:
+        q = command_queues.get(d_id)
+        return q.popleft() if q else None
+
+def ack_upstream(cmd_id, body):
+    return requests.post(f"{{UPSTREAM_URL}}/api/commands/{{cmd_id}}/ack", data=body, headers={{'Content-Type': 'application/json'}}, timeout=10)
+
+def agent_response(data, need):
+    # Same command delivery as the central ingest response, by what the agent advertises
+    resp = {{'status': 'success', 'need': need}}
+    if data.get('backfill'): return resp
+    if data.get('commandsInResponse'): resp['commands'] = take_commands(data['id'], 0)
+    elif not data.get('commandChannel'):
+        cmd = pop_command(data['id'])
+        if cmd:
+            resp['command'] = cmd['action']
+            threading.Thread(target=ack_upstream, args=(cmd['id'], json.dumps({{'status': 'delivered'}})), daemon=True).start()
+    return resp
+
+def release_file(digest):
+    path = os.path.join(RELEASE_DIR, f"{{digest}}.zip")
+    with release_lock:  # One uplink download per release, however many agents ask at once
+        if os.path.exists(path): return path
+        os.makedirs(RELEASE_DIR, exist_ok=True)
+        h = hashlib.sha256()
+        with requests.get(f"{{UPSTREAM_URL}}/api/releases/{{digest}}", stream=True, timeout=30) as r:
+            r.raise_for_status()
+            with open(path + '.part', 'wb') as f:
+                for block in r.iter_content(1 << 16): f.write(block); h.update(block)
+        if h.hexdigest() != digest: os.remove(path + '.part'); raise IOError('Release digest mismatch')
+        os.replace(path + '.part', path)
+        return path
+
+class RelayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, separators=(',', ':')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def parts(self): return self.path.split('?', 1)[0].strip('/').split('/')
+
+    def do_GET(self):
+        parts = self.parts()
+        try:
+            if parts == ['api', 'telemetry']: return self.send_json({{'status': 'active'}})
+            if len(parts) == 4 and parts[:2] == ['api', 'devices'] and parts[3] == 'commands':
+                query = dict(p.split('=', 1) for p in self.path.partition('?')[2].split('&') if '=' in p)
+                wait = min(float(query.get('wait', 0)), COMMAND_WAIT)
+                return self.send_json({{'commands': take_commands(urllib.parse.unquote(parts[2]), wait)}})
+            if len(parts) == 3 and parts[:2] == ['api', 'releases']: return self.send_release(parts[2])
+            self.send_json({{'error': 'Not found'}}, 404)
+        except Exception as e: self.send_json({{'error': str(e)}}, 500)
+
+    def send_release(self, digest):
+        if not all(c in '0123456789abcdef' for c in digest): return self.send_json({{'error': 'Unknown release'}}, 404)
+        path = release_file(digest)
+        size, start = os.path.getsize(path), 0
+        rng, if_range = self.headers.get('Range', ''), self.headers.get('If-Range')
+        if rng.startswith('bytes=') and if_range in (None, f'"{{digest}}"'):
+            start = min(int(rng[6:].split('-', 1)[0] or 0), size)
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('ETag', f'"{{digest}}"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(size - start))
+        if start: self.send_header('Content-Range', f"bytes {{start}}-{{size - 1}}/{{size}}")
+        self.end_headers()
+        with open(path, 'rb') as f: f.seek(start); shutil.copyfileobj(f, self.wfile, 1 << 16)
+
+    def do_POST(self):
+        parts = self.parts()
+        try:
+            if parts == ['api', 'telemetry']:
+                data = json.loads(self.body())
+                return self.send_json(agent_response(data, accept(data, [(time.time(), data.get('stats') or {{}})], self.client_address[0])))
+            if parts == ['api', 'telemetry', 'batch']:
+                d = zlib.decompressobj()
+                buf = d.decompress(self.body(), MAX_BATCH_BYTES)
+                if d.unconsumed_tail: return self.send_json({{'error': f'Batch over {{MAX_BATCH_BYTES}} bytes'}}, 413)
+                if buf[:4] != b'PMB1': return self.send_json({{'error': 'Bad batch header'}}, 400)
+                meta, samples, _ = parse_section(buf, 4)
+                return self.send_json(agent_response(meta, accept(meta, samples, self.client_address[0])))
+            if len(parts) == 4 and parts[:2] == ['api', 'commands'] and parts[3] == 'ack':
+                r = ack_upstream(parts[2], self.body())
+                return self.send_json(r.json(), r.status_code)
+            self.send_json({{'error': 'Not found'}}, 404)
+        except BufferFull: self.send_json({{'error': 'Relay buffer full'}}, 503)
+        except Exception as e: self.send_json({{'error': str(e)}}, 500)
+
+def main():
+    threading.Thread(target=forward_loop, daemon=True).start()
+    print(f"Relay {{RELAY_NAME}} on {{PORT}} -> {{UPSTREAM_URL}}")
+    ThreadingHTTPServer(('0.0.0.0', PORT), RelayHandler).serve_forever()
+
+if __name__ == "__main__": main()
+"""
+    with open("pimonitor_relay.py", "w") as f: f.write(script)
+    return "pimonitor_relay.py"
+
 def main():
     install_dependencies()
+    relay = input("Run as a site relay for other agents? [y/N]: ").strip().lower() == 'y'
     while True:
-        url = input("Server IP: ")
+        url = input("Upstream server IP: " if relay else "Server IP: ")
         if url and test_connection(validate_url(url)): break
-    print(f"Done: {generate_agent_script(validate_url(url))}")
+    if relay:
+        port = input("Local relay port [3000]: ").strip() or "3000"
+        print(f"Done: {generate_relay_script(validate_url(url), int(port))} (point this site's agents at this host)")
+    else: print(f"Done: {generate_agent_script(validate_url(url))}")
 
 if __name__ == "__main__": main()
@@ -7,9 +7,9 @@ def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
 
 def install_dependencies():
-    print("Installing Server dependencies (flask, flask-cors, requests, psutil)...")
+    print("Installing Server dependencies (flask, flask-cors, requests, psutil, waitress, brotli)...")
     try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "flask", "flask-cors", "requests", "psutil"])
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "flask", "flask-cors", "requests", "psutil", "waitress", "brotli"])
         print("✓ Dependencies installed.")
     except Exception as e:
         print(f"X Error installing dependencies: {e}")
@@ -17,12 +17,15 @@ def install_dependencies():
 
 def generate_server_script(port):
     code = f"""
-import time, os, json, threading, requests, zipfile, io, shutil, sys, uuid, socket, psutil, platform, subprocess, signal
-from flask import Flask, request, jsonify, send_from_directory
+import time, os, json, threading, requests, zipfile, io, shutil, sys, uuid, socket, psutil, platform, subprocess, signal, mmap, struct, zlib, hashlib, atexit, collections, gzip, itertools, heapq, operator, bisect, re, mimetypes, urllib.parse
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 from datetime import datetime
 
-PORT = {port}
+PORT = int(os.environ.get('PIMONITOR_PORT', '{port}'))
+STARTED_AT = time.time()
+SERVER_THREADS = int(os.environ.get('PIMONITOR_THREADS', '256'))
+DEVICE_LOCK_STRIPES = 64
 MAX_HISTORY = 50
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
@@ -31,104 +34,1248 @@ SETTINGS_FILE = os.path.join(DATA_DIR, 'settings.json')
 INVITES_FILE = os.path.join(DATA_DIR, 'invites.json')
 MAIL_FILE = os.path.join(DATA_DIR, 'mail.json')
 NOTIF_FILE = os.path.join(DATA_DIR, 'notifications.json')
+TSDB_DIR = os.path.join(DATA_DIR, 'tsdb')
+ALERT_RULES_FILE = os.path.join(DATA_DIR, 'alert_rules.json')
+RELEASES_DIR = os.path.join(DATA_DIR, 'releases')
 DIST_DIR = os.path.join(BASE_DIR, 'dist')
 
-app = Flask(__name__, static_folder='dist', static_url_path='')
-CORS(app, resources={{r"/*": {{"origins": "*"}}}})
+# --- STATIC ASSETS ---
+# dist/ is indexed once at startup: each file gets its type, ETag and cache policy, and compressible files get
+# gzip/brotli variants held in memory (prebuilt .gz/.br from the build are used as-is). Content-hashed files
+# under assets/ are immutable; everything else, index.html included, revalidates by ETag. It never reads data/,
+# so it runs before the data lock, while an outgoing server is still serving.
+STATIC_COMPRESS_MIN = 1024
+STATIC_COMPRESSIBLE = ('.js', '.mjs', '.css', '.html', '.svg', '.json', '.txt', '.map', '.ico', '.wasm')
+HASHED_ASSET = re.compile(r'-[A-Za-z0-9_-]{{8,}}[.][a-z0-9]+$')
+try: import brotli
+except ImportError: brotli = None
 
+class StaticManifest:
+    def __init__(self, root): self.root, self.files = root, {{}}
+
+    def _variant(self, path, suffix, compress, body):
+        if os.path.exists(path + suffix):
+            with open(path + suffix, 'rb') as f: return f.read()
+        return compress(body) if compress else None
+
+    def load(self):
+        files = {{}}
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(('.gz', '.br')): continue
+                path = os.path.join(dirpath, name)
+                rel, st = os.path.relpath(path, self.root).replace(os.sep, '/'), os.stat(path)
+                entry = {{ 'path': path, 'type': mimetypes.guess_type(name)[0] or 'application/octet-stream', 'etag': f"{{st.st_size:x}}-{{int(st.st_mtime):x}}",
+                          'immutable': rel.startswith('assets/') and bool(HASHED_ASSET.search(name)), 'variants': {{}} }}
+                if name.endswith(STATIC_COMPRESSIBLE) and st.st_size >= STATIC_COMPRESS_MIN:
+                    with open(path, 'rb') as f: body = f.read()
+                    entry['etag'] = hashlib.sha1(body).hexdigest()[:16]
+                    for enc, suffix, compress in (('br', '.br', brotli and (lambda b: brotli.compress(b, quality=11))), ('gzip', '.gz', lambda b: gzip.compress(b, 9))):
+                        data = self._variant(path, suffix, compress, body)
+                        if data is not None and len(data) < st.st_size: entry['variants'][enc] = data
+                files[rel] = entry
+        self.files = files
+        return len(files)
+
+    def response(self, rel):
+        entry = self.files.get(rel)
+        if entry is None: return None
+        accept = request.headers.get('Accept-Encoding', '')
+        enc = next((e for e in ('br', 'gzip') if e in entry['variants'] and e in accept), None)
+        tag = f"{{entry['etag']}}-{{enc}}" if enc else entry['etag']
+        headers = {{ 'ETag': f'"{{tag}}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'public, max-age=31536000, immutable' if entry['immutable'] else 'no-cache' }}
+        if request.if_none_match.contains(tag): return Response(status=304, headers=headers)
+        if enc: return Response(entry['variants'][enc], mimetype=entry['type'], headers=dict(headers, **{{'Content-Encoding': enc}}))
+        # Uncompressed files go through wsgi.file_wrapper (and Range support) rather than being read into Python
+        resp = send_file(entry['path'], mimetype=entry['type'], conditional=True, etag=tag)
+        resp.headers.update(headers)
+        return resp
+
+static_files = StaticManifest(DIST_DIR)
+static_files.load()
+
+# --- DATA LOCK ---
+# One server per data/ directory, taken before any journal, setting or segment is read. The updater starts
+# the new server with PIMONITOR_TAKEOVER=<ready file>. The ready file only means the new code imports and its
+# static bundle is indexed; the server then waits here until the old one has flushed its journals and exited.
+# Journal replay, tsdb mapping and binding the port all still happen after that, so they are the downtime.
+# Without PIMONITOR_TAKEOVER a second server exits at once.
+DATA_LOCK_FILE = os.path.join(DATA_DIR, 'server.lock')
+TAKEOVER_FILE = os.environ.get('PIMONITOR_TAKEOVER')
+
+def acquire_data_lock():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    handle = open(DATA_LOCK_FILE, 'a+')
+    if os.name == 'nt':
+        import msvcrt
+        try_lock = lambda: msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        try_lock = lambda: fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if TAKEOVER_FILE: open(TAKEOVER_FILE, 'w').close()
+    while True:
+        try: try_lock(); return handle
+        except OSError:
+            if not TAKEOVER_FILE: sys.exit(f"Another PiMonitor server is using {{DATA_DIR}}")
+            time.sleep(0.05)
+
+data_lock = acquire_data_lock()
+
+app = Flask(__name__, static_folder=None)  # dist/ is served from StaticManifest
+CORS(app, resources={{r"/*": {{"origins": "*"}}}}, expose_headers=['ETag', 'X-Devices-Version', 'X-Devices-Epoch', 'X-Total-Count'])
+
+class StripedLock:
+    def __init__(self, stripes): self.locks = [threading.Lock() for _ in range(stripes)]
+    def __call__(self, key): return self.locks[hash(key) % len(self.locks)]
+
+# Device entries are only mutated under their stripe lock; the dict itself is only added to
 devices_store = {{}}
-pending_updates = {{}}
-pending_commands = {{}}
+device_locks = StripedLock(DEVICE_LOCK_STRIPES)
+# Every device change takes the next fleet-wide version; the epoch tells clients when versions restart
+version_counter = itertools.count(1)
+version_lock = threading.Lock()
+devices_version = 0
+DEVICES_EPOCH = uuid.uuid4().hex[:8]
+GZIP_MIN_BYTES = 1024
 
 update_cache = {{
     "last_check": 0, "status": "up-to-date", "remote_hash": None, "changed_files": [], "error": None
 }}
 
+# --- METRICS ---
+# Each thread records into its own shard (no locks on the hot path); /api/metrics sums the shards.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {{
+    'pimonitor_http_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'pimonitor_telemetry_requests_total': ('counter', 'Telemetry posts by format'),
+    'pimonitor_telemetry_samples_total': ('counter', 'Telemetry samples ingested by format'),
+    'pimonitor_telemetry_payload_bytes_total': ('counter', 'Telemetry request body bytes by format'),
+    'pimonitor_json_io_seconds': ('histogram', 'load_json/save_json and journal flush time'),
+    'pimonitor_json_io_bytes_total': ('counter', 'Bytes read or written by load_json/save_json and journal flushes'),
+    'pimonitor_monitor_loop_seconds': ('histogram', 'monitor_local_system iteration time (nominal 1s)'),
+    'pimonitor_pm2_jlist_seconds': ('histogram', 'Time spent in the pm2 jlist subprocess'),
+    'pimonitor_monitor_loop_lag_seconds': ('gauge', 'Last monitor_local_system overrun beyond its 1s period'),
+    'pimonitor_devices': ('gauge', 'Devices in devices_store'),
+    'pimonitor_devices_online': ('gauge', 'Devices currently online'),
+    'pimonitor_history_segments': ('gauge', 'Open time-series segments'),
+    'pimonitor_history_bytes': ('gauge', 'Mapped time-series segment bytes'),
+    'pimonitor_change_feed_events': ('gauge', 'Events retained in the change feed'),
+    'pimonitor_journal_pending': ('gauge', 'Journal records waiting for the write-behind flush')
+}}
+
+class Metrics:
+    def __init__(self):
+        self.local, self.shards, self.gauges, self.lock = threading.local(), [], {{}}, threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = ({{}}, {{}})
+            with self.lock: self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        counters[(name, labels)] = counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, seconds):
+        hists = self._shard()[1]
+        h = hists.get((name, labels))
+        if h is None: h = hists[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        h[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        h[-1] += seconds
+
+    def collect(self):
+        counters, hists = {{}}, {{}}
+        with self.lock: shards = list(self.shards)
+        for c, h in shards:
+            for key, v in list(c.items()): counters[key] = counters.get(key, 0) + v
+            for key, v in list(h.items()):
+                acc = hists.get(key) or hists.setdefault(key, [0] * len(v))
+                for i, x in enumerate(list(v)): acc[i] += x
+        return counters, hists
+
+metrics = Metrics()
+
 def ensure_data_dir():
     if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
 
 def load_json(filepath, default):
     if os.path.exists(filepath):
+        started = time.perf_counter()
         try:
-            with open(filepath, 'r') as f: return json.load(f)
+            with open(filepath, 'r') as f: data = json.load(f)
+            metrics.inc('pimonitor_json_io_bytes_total', (('op', 'load'),), os.path.getsize(filepath))
+            return data
         except: return default
+        finally: metrics.observe('pimonitor_json_io_seconds', (('op', 'load'),), time.perf_counter() - started)
     return default
 
 def save_json(filepath, data):
+    started = time.perf_counter()
     ensure_data_dir()
-    with open(filepath, 'w') as f: json.dump(data, f, indent=2)
+    body = json.dumps(data, indent=2)
+    with open(filepath, 'w') as f: f.write(body)
+    metrics.inc('pimonitor_json_io_bytes_total', (('op', 'save'),), len(body))
+    metrics.observe('pimonitor_json_io_seconds', (('op', 'save'),), time.perf_counter() - started)
+
+# --- CHANGE FEED ---
+# Single in-memory log of (seq, kind, frame, owner) that every stream subscriber reads with its own cursor.
+# frame is the encoded SSE message, built once at publish time however many dashboards read it.
+# owner is a user id, 'role:<Role>' for every session with that role, or None for everyone.
+FEED_SIZE = 2000
+STREAM_KEEPALIVE = 15
+
+def sse(kind, payload):
+    return f"event: {{kind}}\\ndata: {{json.dumps(payload)}}\\n\\n"
+
+class ChangeFeed:
+    def __init__(self, size):
+        self.events, self.seq, self.cond = collections.deque(maxlen=size), 0, threading.Condition()
+
+    def publish(self, kind, payload, owner=None):
+        frame = sse(kind, payload)  # Encoded outside the lock ingest threads publish under
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, kind, frame, owner))
+            self.cond.notify_all()
+
+    def wait(self, cursor, timeout):
+        with self.cond:
+            if self.seq <= cursor: self.cond.wait(timeout)
+            # Sequence numbers are contiguous, so the new events are the last seq - cursor entries
+            n = min(self.seq - cursor, len(self.events))
+            return [self.events[i] for i in range(-n, 0)], self.seq
+
+change_feed = ChangeFeed(FEED_SIZE)
+
+# --- DATA STORE ---
+# In-memory collections with secondary indexes, persisted through an append-only
+# journal that a background thread flushes (write-behind) and compacts via atomic rename.
+JOURNAL_FLUSH_INTERVAL = 0.5
+JOURNAL_COMPACT_MIN = 1000
+
+class Collection:
+    def __init__(self, name, key, legacy_file=None, indexes=(), owner=None, audience=None):
+        # Changes are published per item to item[owner], or to the whole audience ('*' or a role)
+        self.path = os.path.join(DATA_DIR, f"{{name}}.journal")
+        self.name, self.key, self.owner, self.audience, self.lock = name, key, owner, audience, threading.RLock()
+        self.items, self.indexes = {{}}, {{field: {{}} for field in indexes}}
+        self.pending, self.ops, self.handle = [], 0, None
+        if os.path.exists(self.path): self._replay()
+        elif legacy_file:
+            for item in load_json(legacy_file, []): self._apply(item)
+            if self.items: self.compact()
+
+    def _replay(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: op = json.loads(line)
+                except ValueError: continue  # Torn tail from a crash
+                if 'put' in op: self._apply(op['put'])
+                else: self._remove(op.get('del'))
+                self.ops += 1
+
+    def _apply(self, item):
+        k = item[self.key]
+        old = self.items.get(k)
+        if old is not None: self._unindex(k, old)
+        self.items[k] = item
+        for field, idx in self.indexes.items(): idx.setdefault(item.get(field), {{}})[k] = None
+
+    def _unindex(self, k, item):
+        for field, idx in self.indexes.items():
+            bucket = idx.get(item.get(field))
+            if bucket is not None:
+                bucket.pop(k, None)
+                if not bucket: del idx[item.get(field)]
+
+    def _remove(self, k):
+        item = self.items.pop(k, None)
+        if item is not None: self._unindex(k, item)
+        return item
+
+    def __len__(self): return len(self.items)
+    def get(self, k): return self.items.get(k)
+    def all(self):
+        with self.lock: return list(self.items.values())
+    def find(self, field, value):
+        with self.lock: return [self.items[k] for k in self.indexes[field].get(value, ())]
+
+    def put(self, item):
+        with self.lock:
+            self._apply(item)
+            self.pending.append(json.dumps({{'put': item}}))
+        self._publish('put', item)
+        return item
+
+    def delete(self, k):
+        with self.lock:
+            item = self._remove(k)
+            if item is not None: self.pending.append(json.dumps({{'del': k}}))
+        if item is not None: self._publish('del', item)
+        return item
+
+    def _publish(self, op, item):
+        if self.owner: change_feed.publish(self.name, {{'op': op, 'item': item}}, item.get(self.owner))
+        elif self.audience: change_feed.publish(self.name, {{'op': op, 'item': item}}, None if self.audience == '*' else f"role:{{self.audience}}")
+
+    def flush(self):
+        with self.lock:
+            if not self.pending: return
+            lines, self.pending = self.pending, []
+            started, body = time.perf_counter(), '\\n'.join(lines) + '\\n'
+            if self.handle is None: ensure_data_dir(); self.handle = open(self.path, 'a', encoding='utf-8')
+            self.handle.write(body); self.handle.flush()
+            metrics.inc('pimonitor_json_io_bytes_total', (('op', 'journal'),), len(body))
+            metrics.observe('pimonitor_json_io_seconds', (('op', 'journal'),), time.perf_counter() - started)
+            self.ops += len(lines)
+            if self.ops > max(JOURNAL_COMPACT_MIN, 2 * len(self.items)): self.compact()
+
+    def compact(self):
+        with self.lock:
+            ensure_data_dir()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for item in self.items.values(): f.write(json.dumps({{'put': item}}) + '\\n')
+                f.flush(); os.fsync(f.fileno())
+            if self.handle: self.handle.close(); self.handle = None
+            os.replace(tmp, self.path)
+            self.pending, self.ops = [], len(self.items)
+
+users_db = Collection('users', 'id', USERS_FILE, indexes=('username',), audience='*')
+invites_db = Collection('invites', 'code', INVITES_FILE, audience='Owner')
+mail_db = Collection('mail', 'id', MAIL_FILE, indexes=('toId',), owner='toId')
+notifs_db = Collection('notifications', 'id', NOTIF_FILE, indexes=('userId',), owner='userId')
+COLLECTIONS = (users_db, invites_db, mail_db, notifs_db)
+
+def flush_collections():
+    for c in COLLECTIONS:
+        try: c.flush()
+        except Exception as e: print(f"Journal flush error: {{e}}")
+
+def journal_flusher():
+    while True: time.sleep(JOURNAL_FLUSH_INTERVAL); flush_collections()
+
+atexit.register(flush_collections)
+
+def notify_users(message, kind='info', data=None):
+    now = datetime.now().isoformat()
+    for user in users_db.all():
+        notifs_db.put({{ 'id': str(uuid.uuid4()), 'userId': user['id'], 'type': kind, 'message': message, 'read': False, 'data': data, 'timestamp': now }})
+
+# --- LIVENESS ---
+# One heap entry per live device keyed on its offline deadline; heartbeats only move the deadline,
+# and stale entries are re-pushed lazily when they surface at the top of the heap.
+HEARTBEAT_INTERVAL = 5
+OFFLINE_GRACE = 3
+LIVENESS_TICK = 0.5
+
+class LivenessTracker:
+    def __init__(self):
+        self.heap, self.deadlines, self.intervals, self.lock = [], {{}}, {{}}, threading.Lock()
+
+    def set_interval(self, d_id, seconds):
+        self.intervals[d_id] = max(0.5, float(seconds))
+
+    def heartbeat(self, d_id, now=None):
+        deadline = (now or time.time()) + self.intervals.get(d_id, HEARTBEAT_INTERVAL) * OFFLINE_GRACE
+        with self.lock:
+            if d_id not in self.deadlines: heapq.heappush(self.heap, (deadline, d_id))
+            self.deadlines[d_id] = deadline
+
+    def is_online(self, d_id): return d_id in self.deadlines
+
+    def expire(self, now):
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, d_id = heapq.heappop(self.heap)
+                deadline = self.deadlines.get(d_id)
+                if deadline is None: continue
+                if deadline > now: heapq.heappush(self.heap, (deadline, d_id))
+                else: del self.deadlines[d_id]; expired.append(d_id)
+        return expired
+
+liveness = LivenessTracker()
+
+# --- FLEET AGGREGATES ---
+# Running sums over online devices are adjusted by each device's delta; top-N views are lazy max-heaps
+# whose stale entries (older stamp for the device) are dropped as they surface or on periodic rebuild.
+FLEET_FIELDS = {{'cpu': 'cpuUsage', 'memory': 'memoryUsage', 'disk': 'diskUsage', 'networkIn': 'networkIn', 'networkOut': 'networkOut'}}
+FLEET_TOP_METRICS = ('cpu', 'memory', 'disk')
+FLEET_TOP_DEFAULT = 5
+
+class FleetAggregates:
+    def __init__(self):
+        self.lock, self.current, self.stamps = threading.Lock(), {{}}, itertools.count()
+        self.sums = dict.fromkeys(list(FLEET_FIELDS) + ['processes'], 0.0)
+        self.heaps = {{m: [] for m in FLEET_TOP_METRICS}}
+
+    def update(self, d_id, stats, process_count=0):
+        vals = {{k: float(stats.get(f) or 0) for k, f in FLEET_FIELDS.items()}}
+        vals['processes'] = process_count
+        with self.lock:
+            old, stamp = self.current.get(d_id), next(self.stamps)
+            for k, v in vals.items(): self.sums[k] += v - (old[0][k] if old else 0)
+            self.current[d_id] = (vals, stamp)
+            for m in FLEET_TOP_METRICS: heapq.heappush(self.heaps[m], (-vals[m], stamp, d_id))
+            if len(self.heaps[FLEET_TOP_METRICS[0]]) > 4 * len(self.current) + 64: self._rebuild()
+
+    def remove(self, d_id):
+        with self.lock:
+            old = self.current.pop(d_id, None)
+            if old:
+                for k, v in old[0].items(): self.sums[k] -= v
+
+    def _rebuild(self):
+        self.heaps = {{m: [(-vals[m], stamp, d_id) for d_id, (vals, stamp) in self.current.items()] for m in FLEET_TOP_METRICS}}
+        for heap in self.heaps.values(): heapq.heapify(heap)
+        self.sums = {{k: sum(vals[k] for vals, _ in self.current.values()) for k in self.sums}}  # Also clears float drift
+
+    def top(self, metric, n):
+        with self.lock:
+            heap, out = self.heaps[metric], []
+            while heap and len(out) < n:
+                entry = heapq.heappop(heap)
+                cur = self.current.get(entry[2])
+                if cur is not None and cur[1] == entry[1]: out.append(entry)
+            for entry in out: heapq.heappush(heap, entry)
+        return [(d_id, -neg) for neg, _, d_id in out]
+
+    def summary(self, n):
+        with self.lock: count, sums = len(self.current), dict(self.sums)
+        mean = lambda k: round(sums[k] / count, 2) if count else 0
+        tops = {{m: self.top(m, n) for m in FLEET_TOP_METRICS}}
+        return {{
+            'online': count,
+            'cpu': {{ 'mean': mean('cpu'), 'max': tops['cpu'][0][1] if tops['cpu'] else 0 }},
+            'memory': {{ 'mean': mean('memory'), 'max': tops['memory'][0][1] if tops['memory'] else 0 }},
+            'network': {{ 'in': round(sums['networkIn'], 1), 'out': round(sums['networkOut'], 1) }},
+            'processes': int(sums['processes']),
+            'top': {{m: [{{ 'id': d_id, 'name': (devices_store.get(d_id) or {{}}).get('name', d_id), 'value': v }} for d_id, v in entries] for m, entries in tops.items()}}
+        }}
+
+fleet = FleetAggregates()
+
+# --- COMMAND CHANNEL ---
+# Per-device FIFO of commands with ids. Agents long-poll their queue (one condition per device,
+# so a fan-out only wakes the targeted agents) and report results through the ack endpoint.
+COMMAND_ACTIONS = ('reboot', 'shutdown')
+COMMAND_POLL_TIMEOUT = 25
+MAX_COMMANDS = 10000
+COMMAND_ACK_TIMEOUT = 60  # A sent command without an ack by then is requeued (the response may have been lost)
+COMMAND_MAX_ATTEMPTS = 3
+# Long-polls and SSE streams park a pool thread each, so each gets its own bounded share of the pool and ingest
+# never queues behind them. Streams have separate slots so a busy fleet cannot lock dashboards out.
+# Only LONG_POLL_SLOTS agents get instant command delivery; the rest are told to back off and pick commands
+# up from their telemetry responses (one heartbeat, 5s by default). Raise PIMONITOR_THREADS to ~4x the
+# fleet size to long-poll every agent.
+LONG_POLL_SLOTS = max(1, SERVER_THREADS // 4)
+STREAM_SLOTS = max(1, SERVER_THREADS // 16)
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_SLOTS)
+stream_slots = threading.BoundedSemaphore(STREAM_SLOTS)
+
+class CommandQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues, self.conds, self.commands, self.order, self.inflight = {{}}, {{}}, {{}}, collections.deque(), {{}}
+
+    def _cond(self, d_id):
+        cond = self.conds.get(d_id)
+        if cond is None: cond = self.conds[d_id] = threading.Condition(self.lock)
+        return cond
+
+    def enqueue(self, d_id, action, args=None):
+        cmd = {{ 'id': str(uuid.uuid4()), 'deviceId': d_id, 'action': action, 'args': args, 'status': 'queued', 'createdAt': time.time() }}
+        with self.lock:
+            self.queues.setdefault(d_id, collections.deque()).append(cmd)
+            self.commands[cmd['id']] = cmd
+            self.order.append(cmd['id'])
+            while len(self.order) > MAX_COMMANDS: self.commands.pop(self.order.popleft(), None)
+            self._cond(d_id).notify_all()
+            cmd = dict(cmd)
+        change_feed.publish('command', cmd)
+        return cmd
+
+    def take(self, d_id, timeout=0, limit=None):
+        deadline = time.time() + timeout
+        with self.lock:
+            while not self.queues.get(d_id):
+                remaining = deadline - time.time()
+                if remaining <= 0: return []
+                self._cond(d_id).wait(remaining)
+            q, out = self.queues[d_id], []
+            while q and (limit is None or len(out) < limit):
+                cmd = q.popleft()
+                cmd['status'], cmd['sentAt'], cmd['attempts'] = 'sent', time.time(), cmd.get('attempts', 0) + 1
+                self.inflight[cmd['id']] = cmd
+                out.append(dict(cmd))
+        return out
+
+    def requeue_stale(self, now):
+        changed = []
+        with self.lock:
+            for cmd in [c for c in self.inflight.values() if now - c['sentAt'] > COMMAND_ACK_TIMEOUT]:
+                del self.inflight[cmd['id']]
+                if cmd['attempts'] >= COMMAND_MAX_ATTEMPTS: cmd['status'] = 'expired'
+                else:
+                    cmd['status'] = 'queued'
+                    self.queues.setdefault(cmd['deviceId'], collections.deque()).appendleft(cmd)
+                    self._cond(cmd['deviceId']).notify_all()
+                changed.append(dict(cmd))
+        for cmd in changed: change_feed.publish('command', cmd)
+
+    def ack(self, cmd_id, status, result=None):
+        with self.lock:
+            cmd = self.commands.get(cmd_id)
+            if cmd is None: return None
+            self.inflight.pop(cmd_id, None)
+            q = self.queues.get(cmd['deviceId'])
+            if cmd['status'] == 'queued' and q and cmd in q: q.remove(cmd)  # Late ack for a command we had requeued
+            cmd.update(status=status, result=result, ackedAt=time.time())
+            cmd = dict(cmd)
+        change_feed.publish('command', cmd)
+        return cmd
+
+    def get(self, cmd_id):
+        with self.lock:
+            cmd = self.commands.get(cmd_id)
+            return dict(cmd) if cmd else None
+
+commands = CommandQueue()
+
+# --- RELEASES & ROLLOUTS ---
+# The agent bundle is fetched from the repo once per commit and stored content-addressed; agents
+# download it from us. Rollouts send 'update' commands wave by wave and only advance once the
+# current wave reports the new agentVersion.
+AGENT_FILES = ('setup_device.py',)
+ROLLOUT_TICK = 1
+ROLLOUT_DEFAULTS = {{'canary': 1, 'waveSize': 10, 'maxConcurrent': 5, 'healthTimeout': 300, 'maxFailures': 0}}
+
+def archive_url(repo):
+    if "github.com" in repo and not repo.endswith(".zip"): return repo.rstrip('/') + "/archive/refs/heads/main.zip"
+    return repo
+
+class ReleaseCache:
+    def __init__(self, root):
+        self.root, self.lock = root, threading.Lock()
+        self.index = load_json(os.path.join(root, 'index.json'), {{}})
+
+    def path(self, digest): return os.path.join(self.root, f"{{digest}}.zip")
+
+    def get(self, digest):
+        return next((r for r in self.index.values() if r['digest'] == digest), None) if os.path.exists(self.path(digest)) else None
+
+    def fetch(self, repo, token, commit=None):
+        with self.lock:
+            cached = self.index.get(commit) if commit else None
+            if cached and os.path.exists(self.path(cached['digest'])): return cached
+            os.makedirs(self.root, exist_ok=True)
+            tmp = os.path.join(self.root, f"download-{{uuid.uuid4().hex}}.zip")
+            try:
+                with requests.get(archive_url(repo), headers={{'Authorization': f'token {{token}}'}} if token else {{}}, stream=True, timeout=30) as r:
+                    r.raise_for_status()
+                    with open(tmp, 'wb') as f:
+                        for block in r.iter_content(1 << 16): f.write(block)
+                bundle = io.BytesIO()
+                with zipfile.ZipFile(tmp) as src, zipfile.ZipFile(bundle, 'w', zipfile.ZIP_DEFLATED) as out:
+                    for info in src.infolist():
+                        parts = info.filename.split('/')
+                        if len(parts) <= 2 and parts[-1] in AGENT_FILES: out.writestr(zipfile.ZipInfo(parts[-1], (1980, 1, 1, 0, 0, 0)), src.read(info))  # Fixed date keeps the digest stable
+                    if len(out.namelist()) != len(AGENT_FILES): raise ValueError('Archive is missing agent files')
+            finally:
+                if os.path.exists(tmp): os.remove(tmp)
+            body = bundle.getvalue()
+            digest = hashlib.sha256(body).hexdigest()
+            if not os.path.exists(self.path(digest)):
+                with open(self.path(digest) + '.tmp', 'wb') as f: f.write(body)
+                os.replace(self.path(digest) + '.tmp', self.path(digest))
+            release = {{ 'digest': digest, 'size': len(body), 'commit': commit, 'fetchedAt': time.time() }}
+            self.index[commit or digest] = release
+            save_json(os.path.join(self.root, 'index.json'), self.index)
+            return release
+
+releases = ReleaseCache(RELEASES_DIR)
+
+class RolloutScheduler:
+    def __init__(self): self.lock, self.rollouts = threading.Lock(), {{}}
+
+    def create(self, ids, options):
+        opts = {{k: int(options.get(k, v)) for k, v in ROLLOUT_DEFAULTS.items()}}
+        canary, size = max(1, opts['canary']), max(1, opts['waveSize'])
+        waves = [ids[:canary]] + [ids[i:i + size] for i in range(canary, len(ids), size)]
+        rollout = dict(opts, id=str(uuid.uuid4()), status='fetching', release=None, error=None, wave=0, waves=[w for w in waves if w], createdAt=time.time(),
+                       devices={{d_id: {{ 'state': 'pending', 'commandId': None, 'since': None, 'error': None }} for d_id in ids}})
+        with self.lock: self.rollouts[rollout['id']] = rollout
+        threading.Thread(target=self._fetch, args=(rollout,), daemon=True).start()
+        return self.get(rollout['id'])
+
+    def _fetch(self, rollout):
+        try: release = releases.fetch(server_settings.get('repoUrl', ''), server_settings.get('githubToken', ''), update_cache.get('remote_hash'))
+        except Exception as e: release, error = None, str(e)
+        with self.lock:
+            if rollout['status'] != 'fetching': return
+            if release: rollout['release'], rollout['status'] = release, 'running'
+            else: rollout['status'], rollout['error'] = 'failed', f"Release fetch failed: {{error}}"
+        self._publish(rollout)
+
+    def get(self, r_id):
+        with self.lock:
+            rollout = self.rollouts.get(r_id)
+            return json.loads(json.dumps(rollout)) if rollout else None
+
+    def all(self):
+        with self.lock: ids = list(self.rollouts)
+        return [self.get(r_id) for r_id in ids]
+
+    def control(self, r_id, action):
+        with self.lock:
+            rollout = self.rollouts.get(r_id)
+            if rollout is None: return None
+            if action == 'pause' and rollout['status'] == 'running': rollout['status'] = 'paused'
+            elif action == 'resume' and rollout['status'] == 'paused':
+                for st in rollout['devices'].values():
+                    if st['state'] == 'failed': st.update(state='skipped')  # Resuming accepts the failures that paused it
+                rollout['status'] = 'running'
+            elif action == 'cancel' and rollout['status'] in ('fetching', 'running', 'paused'): rollout['status'] = 'cancelled'
+        self._publish(rollout)
+        return self.get(r_id)
+
+    def _publish(self, rollout):
+        change_feed.publish('rollout', self.get(rollout['id']))
+
+    def tick(self, now):
+        with self.lock: active = [r for r in self.rollouts.values() if r['status'] == 'running']
+        for rollout in active:
+            with self.lock: changed = self._advance(rollout, now)
+            if changed: self._publish(rollout)
+
+    def _advance(self, rollout, now):
+        digest, changed = rollout['release']['digest'], False
+        wave = rollout['waves'][rollout['wave']]
+        for d_id in wave:
+            st = rollout['devices'][d_id]
+            if st['state'] not in ('sent', 'acked'): continue
+            cmd = commands.get(st['commandId']) or {{}}
+            dev = devices_store.get(d_id) or {{}}
+            if cmd.get('status') in ('failed', 'expired'): st.update(state='failed', error=cmd.get('result') or f"Update {{cmd['status']}}"); changed = True
+            elif dev.get('agentVersion') == digest and liveness.is_online(d_id): st['state'] = 'healthy'; changed = True
+            elif cmd.get('status') == 'done' and st['state'] == 'sent': st['state'] = 'acked'; changed = True
+            elif now - st['since'] > rollout['healthTimeout']: st.update(state='failed', error='Health check timed out'); changed = True
+        states = [rollout['devices'][d_id]['state'] for d_id in wave]
+        if states.count('failed') > rollout['maxFailures']:
+            rollout['status'], rollout['error'] = 'paused', f"Wave {{rollout['wave'] + 1}} exceeded {{rollout['maxFailures']}} failures"
+            return True
+        in_flight = states.count('sent') + states.count('acked')
+        for d_id in wave:
+            st = rollout['devices'][d_id]
+            if st['state'] != 'pending' or in_flight >= rollout['maxConcurrent']: continue
+            if (devices_store.get(d_id) or {{}}).get('agentVersion') == digest: st['state'] = 'healthy'
+            else:
+                args = {{ 'path': f"/api/releases/{{digest}}", 'digest': digest, 'size': rollout['release']['size'] }}
+                st.update(state='sent', since=now, commandId=commands.enqueue(d_id, 'update', args)['id'])
+                in_flight += 1
+            changed = True
+        if all(rollout['devices'][d_id]['state'] in ('healthy', 'failed', 'skipped') for d_id in wave):
+            rollout['wave'] += 1
+            if rollout['wave'] >= len(rollout['waves']): rollout['wave'], rollout['status'] = len(rollout['waves']) - 1, 'done'
+            changed = True
+        return changed
+
+rollouts = RolloutScheduler()
+
+# --- ALERT RULES ---
+# Rules are compiled into per-metric closures once; each sample only touches the rules for the
+# metrics it carries, and every (device, rule) keeps O(1) state (rolling window, breach start, cooldown).
+ALERT_COOLDOWN = 300
+ALERT_OPS = {{'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}}
+DEFAULT_ALERT_RULES = [
+    {{ 'id': 'cpu-high', 'metric': 'cpuUsage', 'op': '>', 'value': 90, 'for': 60, 'message': 'CPU above 90% for 60s' }},
+    {{ 'id': 'memory-high', 'metric': 'memoryUsage', 'agg': 'mean', 'window': 300, 'op': '>', 'value': 90, 'message': 'Memory averaged above 90% over 5m' }},
+    {{ 'id': 'disk-full', 'metric': 'diskUsage', 'op': '>', 'value': 95, 'message': 'Disk above 95%' }},
+    {{ 'id': 'pm2-restart', 'metric': 'processRestarts', 'op': 'increase', 'cooldown': 60, 'message': 'pm2 process restarted' }}
+]
+
+class RollingWindow:
+    __slots__ = ('span', 'items', 'total', 'peaks')
+    def __init__(self, span): self.span, self.items, self.total, self.peaks = span, collections.deque(), 0.0, collections.deque()
+
+    def push(self, ts, value):
+        self.items.append((ts, value)); self.total += value
+        while self.peaks and self.peaks[-1][1] <= value: self.peaks.pop()
+        self.peaks.append((ts, value))
+        while self.items[0][0] <= ts - self.span: self.total -= self.items.popleft()[1]
+        while self.peaks[0][0] <= ts - self.span: self.peaks.popleft()
+
+    def mean(self): return self.total / len(self.items)
+    def max(self): return self.peaks[0][1]
+
+def compile_rule(rule):
+    # Returns (rule with numeric fields coerced, check); anything malformed raises before a rule set is accepted
+    if not isinstance(rule, dict): raise TypeError('rule must be an object')
+    for field in ('id', 'metric'):
+        if not isinstance(rule.get(field), str) or not rule[field]: raise ValueError(f"missing {{field}}")
+    op, threshold, hold = rule.get('op', '>'), float(rule.get('value', 0)), float(rule.get('for', 0))
+    agg, window = rule.get('agg'), float(rule.get('window', 60))
+    rule = dict(rule, value=threshold, cooldown=float(rule.get('cooldown', ALERT_COOLDOWN)))
+    if op == 'increase':
+        def check(st, ts, v):
+            prev = st.get('prev'); st['prev'] = v
+            return prev is not None and v > prev
+        return rule, check
+    if window <= 0: raise ValueError('window must be positive')
+    if op not in ALERT_OPS: raise ValueError(f"unknown op {{op}}")
+    if agg not in (None, 'mean', 'max'): raise ValueError(f"unknown agg {{agg}}")
+    cmp = ALERT_OPS[op]
+    def check(st, ts, v):
+        if agg:
+            win = st.get('win') or st.setdefault('win', RollingWindow(window))
+            win.push(ts, v)
+            v = win.mean() if agg == 'mean' else win.max()
+        if not cmp(v, threshold): st['since'] = None; return False
+        if st.get('since') is None: st['since'] = ts
+        return ts - st['since'] >= hold
+    return rule, check
+
+class AlertEngine:
+    def __init__(self, rules): self.load(rules)
+
+    def load(self, rules):
+        if not isinstance(rules, list): raise TypeError('rules must be a list')
+        by_metric, ids = {{}}, set()
+        for rule, check in map(compile_rule, rules):
+            if rule['id'] in ids: raise ValueError(f"duplicate id {{rule['id']}}")
+            ids.add(rule['id'])
+            by_metric.setdefault(rule['metric'], []).append((rule, check))
+        self.rules, self.by_metric, self.state = rules, by_metric, {{}}
+
+    def observe(self, d_id, ts, values):
+        fired = []
+        for metric, v in values.items():
+            for rule, check in self.by_metric.get(metric, ()):
+                key = (d_id, rule['id'])
+                st = self.state.get(key) or self.state.setdefault(key, {{}})
+                if ts < st.get('ts', 0): continue  # Late (backfilled) sample, windows only move forward
+                st['ts'] = ts
+                if not check(st, ts, float(v or 0)): st['active'] = False; continue
+                if st.get('active'): continue
+                st['active'] = True
+                if ts - st.get('fired', 0) < rule['cooldown']: continue
+                st['fired'] = ts
+                fired.append((rule, v))
+        return fired
+
+try: alerts = AlertEngine(load_json(ALERT_RULES_FILE, DEFAULT_ALERT_RULES))
+except (KeyError, ValueError, TypeError) as e:
+    print(f"Invalid {{ALERT_RULES_FILE}} ({{e}}), using the default alert rules")
+    alerts = AlertEngine(DEFAULT_ALERT_RULES)
+
+def evaluate_alerts(dev, samples):
+    # Alerting is best effort: a bad sample or rule must never fail the ingest that carried it
+    try:
+        fired = []
+        for ts, st in samples: fired += alerts.observe(dev['id'], ts or time.time(), st)
+        restarts = sum(p.get('restarts') or 0 for p in dev.get('processes') or [])
+        return fired + alerts.observe(dev['id'], time.time(), {{'processRestarts': restarts}})
+    except Exception as e:
+        print(f"Alert evaluation error for {{dev['id']}}: {{e}}")
+        return []
+
+def raise_alerts(dev, fired):
+    for rule, v in fired:
+        notify_users(f"{{dev['name']}}: {{rule.get('message') or rule['id']}} ({{round(float(v or 0), 1)}})", 'alert', {{'deviceId': dev['id'], 'ruleId': rule['id'], 'value': v}})
 
 server_settings = load_json(SETTINGS_FILE, {{ "repoUrl": "https://github.com/user/repo", "localHash": "init" }})
 
+# --- TIME SERIES STORE ---
+# One memory-mapped segment file per device/metric, named by the percent-encoded device id so distinct ids
+# never share a file. Segments are held by path; (id, metric) lookups are a cache over that. Each tier is a fixed ring of
+# [bucket_ts, sum, count, max] doubles indexed directly by bucket, so appends are
+# O(tiers), memory stays flat and a restart only has to re-map the files.
+TS_METRICS = ('cpu', 'memory', 'network')
+TS_TIERS = ((1, 3600), (60, 10080), (3600, 2160))  # (step seconds, slots): 1h @ 1s, 7d @ 1m, 90d @ 1h
+TS_FIELDS = 4
+RECENT_SCAN_FACTOR = 10  # recent() gives up after count * factor empty-or-filled 1s slots
+HISTORY_MAX_RAW = 20000  # queries use a coarser tier rather than scan more raw buckets than this
+HISTORY_DEFAULT_POINTS = 500
+
+# --- BATCH WIRE FORMAT ---
+# zlib( b'PMB1' | u32 meta_len | meta json | u32 count | count * (f64 ts, 8 * f32 stats) )
+# Relays send zlib( b'PMR1' | u32 n | n * (u32 meta_len | meta json | u32 count | rows) ), one section per device
+STAT_FIELDS = ('cpuUsage', 'memoryUsage', 'memoryUsed', 'memoryTotal', 'temperature', 'networkIn', 'networkOut', 'diskUsage')
+SAMPLE_STRUCT = struct.Struct('<d8f')
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# --- DELTA PAYLOADS ---
+# Agents send hashes of their hardware and process metadata; full copies only when asked via resp['need']
+PROC_NUMBERS = ('cpu', 'memory', 'restarts', 'uptime')
+device_hashes = {{}}
+
+# --- CLOCK SKEW ---
+# Agents (often Pis without an RTC) stamp samples with their own clock. Each live post gives the device's offset
+# (server time minus its sentAt, or its newest sample for older agents); beyond the tolerance, batches are shifted
+# by it with their spacing kept, and backfill reuses the last live offset.
+CLOCK_SKEW_TOLERANCE = 2
+device_clock = {{}}
+
+class TimeSeriesStore:
+    def __init__(self, root):
+        self.root, self.segments, self.by_id, self.lock = root, {{}}, {{}}, threading.Lock()
+        self.offsets, off = [], 0
+        for step, slots in TS_TIERS: self.offsets.append(off); off += slots * TS_FIELDS
+        self.size = off * 8
+
+    def _path(self, d_id, metric):
+        return os.path.join(self.root, f"{{urllib.parse.quote(str(d_id), safe='')}}.{{metric}}.seg")
+
+    def _map(self, path):
+        # Caller holds self.lock
+        seg = self.segments.get(path)
+        if seg is None:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path, 'a+b') as f:
+                if os.path.getsize(path) != self.size: f.truncate(0); f.truncate(self.size)
+                seg = memoryview(mmap.mmap(f.fileno(), self.size)).cast('d')
+            self.segments[path] = seg
+        return seg
+
+    def _segment(self, d_id, metric, create=True):
+        seg = self.by_id.get((d_id, metric))
+        if seg is not None: return seg
+        with self.lock:
+            seg = self.by_id.get((d_id, metric))
+            if seg is not None: return seg
+            path = self._path(d_id, metric)
+            if not create and path not in self.segments and not os.path.exists(path): return None
+            seg = self.by_id[(d_id, metric)] = self._map(path)
+            return seg
+
+    def load(self):
+        if not os.path.isdir(self.root): return 0
+        with self.lock:
+            for name in os.listdir(self.root):
+                if name.endswith('.seg'): self._map(os.path.join(self.root, name))
+        return len(self.segments)
+
+    def append(self, d_id, values, ts=None):
+        ts = int(ts or time.time())
+        for metric, value in values.items():
+            seg, value = self._segment(d_id, metric), float(value or 0)
+            for (step, slots), off in zip(TS_TIERS, self.offsets):
+                bucket = ts // step * step
+                i = off + (bucket // step % slots) * TS_FIELDS
+                if seg[i] == bucket: seg[i+1] += value; seg[i+2] += 1; seg[i+3] = max(seg[i+3], value)
+                elif seg[i] < bucket: seg[i], seg[i+1], seg[i+2], seg[i+3] = bucket, value, 1, value
+                # else the slot already holds a newer bucket: a late sample older than this tier retains
+
+    def query(self, d_id, metric, start, end, tier=None):
+        now = time.time()
+        if tier is None: tier = next((t for t, (s, n) in enumerate(TS_TIERS) if now - start <= s * n), len(TS_TIERS) - 1)
+        seg = self._segment(d_id, metric, create=False)
+        if seg is None: return []
+        (step, slots), off, out = TS_TIERS[tier], self.offsets[tier], []
+        b, end = max(int(start) // step * step, (int(now) // step - slots + 1) * step), min(end, now)
+        while b <= end:
+            i = off + (b // step % slots) * TS_FIELDS
+            if seg[i] == b and seg[i+2]: out.append((b, seg[i+1] / seg[i+2], seg[i+3]))
+            b += step
+        return out
+
+    def recent(self, d_id, metric, count, end=None):
+        seg = self._segment(d_id, metric, create=False)
+        if seg is None: return []
+        step, slots = TS_TIERS[0]
+        out, b = [], int(end or time.time()) // step * step
+        for _ in range(min(slots, count * RECENT_SCAN_FACTOR)):
+            i = (b // step % slots) * TS_FIELDS
+            if seg[i] == b and seg[i+2]:
+                out.append((b, seg[i+1] / seg[i+2], seg[i+3]))
+                if len(out) >= count: break
+            b -= step
+        out.reverse()
+        return out
+
+tsdb = TimeSeriesStore(TSDB_DIR)
+
+def lttb_indices(ts, vs, threshold):
+    n = len(ts)
+    if threshold >= n or threshold < 3: return list(range(n))
+    every, a, out = (n - 2) / (threshold - 2), 0, [0]
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        nend = min(int((i + 2) * every) + 1, n)
+        avg_t, avg_v = sum(ts[end:nend]) / (nend - end), sum(vs[end:nend]) / (nend - end)
+        ax, ay, best, best_area = ts[a], vs[a], start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_t) * (vs[j] - ay) - (ax - ts[j]) * (avg_v - ay))
+            if area > best_area: best_area, best = area, j
+        out.append(best); a = best
+    out.append(n - 1)
+    return out
+
+def minmax_indices(vs, threshold):
+    n, buckets = len(vs), max(1, threshold // 2)
+    if threshold >= n: return list(range(n))
+    out = []
+    for i in range(buckets):
+        lo, hi = i * n // buckets, (i + 1) * n // buckets
+        if lo >= hi: continue
+        chunk = vs[lo:hi]
+        a, b = lo + chunk.index(min(chunk)), lo + chunk.index(max(chunk))
+        out += sorted({{a, b}})
+    return out
+
+def record_sample(d_id, stats, ts=None):
+    tsdb.append(d_id, {{ 'cpu': stats.get('cpuUsage', 0), 'memory': stats.get('memoryUsage', 0), 'network': stats.get('networkIn', 0) }}, ts)
+
+def touch_device(dev):
+    global devices_version
+    with version_lock: dev['version'] = devices_version = next(version_counter)
+
+def json_response(payload, status=200, headers=None):
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    resp = Response(body, status=status, mimetype='application/json', headers=headers)
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resp.set_data(gzip.compress(body, 5))
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+def publish_device(dev, samples, full=False):
+    touch_device(dev)
+    ev = {{k: dev.get(k) for k in ('id', 'name', 'ip', 'os', 'status', 'lastSeen', 'stats', 'processes', 'agentVersion')}}
+    if full: ev['hardware'] = dev.get('hardware')
+    ev['points'] = [[ts or dev['lastSeen'], st.get('cpuUsage', 0), st.get('memoryUsage', 0), st.get('networkIn', 0)] for ts, st in samples]
+    change_feed.publish('device', ev)
+
+def parse_section(buf, off):
+    (meta_len,) = struct.unpack_from('<I', buf, off)
+    meta = json.loads(buf[off + 4:off + 4 + meta_len])
+    (count,) = struct.unpack_from('<I', buf, off + 4 + meta_len)
+    start = off + 8 + meta_len
+    body = buf[start:start + count * SAMPLE_STRUCT.size]
+    if len(body) != count * SAMPLE_STRUCT.size: raise ValueError('Truncated batch')
+    return meta, [(row[0], {{k: round(v, 2) for k, v in zip(STAT_FIELDS, row[1:])}}) for row in SAMPLE_STRUCT.iter_unpack(body)], start + len(body)
+
+class BatchTooLarge(ValueError): pass
+
+def inflate(raw):
+    d = zlib.decompressobj()
+    buf = d.decompress(raw, MAX_BATCH_BYTES)
+    if d.unconsumed_tail: raise BatchTooLarge(f'Batch over {{MAX_BATCH_BYTES}} bytes')
+    return buf
+
+def decode_batch(raw):
+    buf = inflate(raw)
+    if buf[:4] != b'PMB1': raise ValueError('Bad batch header')
+    return parse_section(buf, 4)[:2]
+
+def decode_relay(raw):
+    buf = inflate(raw)
+    if buf[:4] != b'PMR1': raise ValueError('Bad relay header')
+    (count,) = struct.unpack_from('<I', buf, 4)
+    sections, off = [], 8
+    for _ in range(count):
+        meta, samples, off = parse_section(buf, off)
+        sections.append((meta, samples))
+    return sections
+
+def correct_clock(d_id, data, samples):
+    if not samples: return samples
+    if not data.get('backfill'):
+        ref = data.get('sentAt') or samples[-1][0]
+        if ref: device_clock[d_id] = time.time() - ref
+    offset = device_clock.get(d_id, 0)
+    if abs(offset) <= CLOCK_SKEW_TOLERANCE: return samples
+    return [(ts + offset if ts else ts, st) for ts, st in samples]
+
+def apply_delta(d_id, dev, data):
+    known, need = device_hashes.setdefault(d_id, {{}}), []
+    if 'hardware' in data: dev['hardware'] = data['hardware']; known['hardware'] = data.get('hardwareHash')
+    elif data.get('hardwareHash') != known.get('hardware'): need.append('hardware')
+    if 'processes' in data: dev['processes'] = data['processes']; known['processes'] = data.get('processHash')
+    elif data.get('processHash') != known.get('processes'): need.append('processes')
+    else:
+        try:
+            for i, nums in (data.get('processDelta') or {{}}).items(): dev['processes'][int(i)].update(zip(PROC_NUMBERS, nums))
+        except (IndexError, ValueError, TypeError, AttributeError): known['processes'] = None; need.append('processes')
+    return need
+
+def device_history(d_id, end=None):
+    return {{m: [{{ 'time': datetime.fromtimestamp(t).strftime('%H:%M:%S'), 'value': round(v, 2) }} for t, v, _ in tsdb.recent(d_id, m, MAX_HISTORY, end)] for m in TS_METRICS}}
+
+# --- PROCESSES ---
+# psutil reads for the local server's process list; Process objects are cached by pid so cpu_percent is an
+# incremental delta, and pm2 jlist only runs when a managed pid exits or every PM2_INTERVAL seconds.
+PROCESS_INTERVAL = 5
+PROCESS_TOP_N = int(os.environ.get('PIMONITOR_TOP_PROCESSES', '10'))
+WATCH_PROCESSES = [n for n in os.environ.get('PIMONITOR_WATCH', '').split(',') if n]
+PM2_INTERVAL = 60
+PROC_ATTRS = ['name', 'create_time', 'status', 'memory_info']
+STOPPED_STATUSES = (psutil.STATUS_ZOMBIE, psutil.STATUS_STOPPED, psutil.STATUS_DEAD)
+
+def format_uptime(seconds):
+    seconds = int(max(0, seconds))
+    units = [(seconds // 86400, 'd'), (seconds // 3600 % 24, 'h'), (seconds // 60 % 60, 'm'), (seconds % 60, 's')]
+    return ' '.join([f"{{n}}{{u}}" for n, u in units if n][:2]) or '0s'
+
+class ProcessCollector:
+    def __init__(self, top_n, watch, pm2_interval, on_pm2=None):
+        self.top_n, self.watch, self.pm2_interval, self.on_pm2 = top_n, set(watch), pm2_interval, on_pm2
+        self.cache, self.selected, self.pm2, self.pm2_at = {{}}, set(), {{}}, 0
+
+    def _refresh_pm2(self):
+        started = time.perf_counter()
+        try:
+            cmd = ['pm2', 'jlist']
+            res = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL) if os.name == 'nt' else subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+            self.pm2 = {{(p.get('name'), p.get('pm_id')): {{
+                "pid": p.get("pid") or 0, "pm_id": p.get("pm_id"),
+                "status": p.get('pm2_env', {{}}).get('status', 'stopped'),
+                "restarts": p.get('pm2_env', {{}}).get('restart_time', 0)
+            }} for p in json.loads(res)}}
+            if self.on_pm2: self.on_pm2(time.perf_counter() - started)
+        except (OSError, ValueError, subprocess.CalledProcessError): self.pm2 = {{}}  # No pm2 here
+        self.pm2_at = time.monotonic()
+
+    def collect(self):
+        rows, seen = {{}}, set()
+        for p in psutil.process_iter(PROC_ATTRS):
+            info, pid = p.info, p.pid
+            seen.add(pid)
+            cached = self.cache.get(pid)
+            if cached is None or cached[1] != info['create_time']: cached = self.cache[pid] = (p, info['create_time'])
+            try: cpu = cached[0].cpu_percent(None)  # Delta since this object's previous call; 0 on first sight
+            except psutil.Error: continue
+            rss = info['memory_info'].rss if info['memory_info'] else 0
+            rows[pid] = {{ "pid": pid, "name": info['name'] or str(pid), "pm_id": -1, "cpu": round(cpu, 1), "memory": round(rss / 1024 / 1024, 1),
+                          "status": 'stopped' if info['status'] in STOPPED_STATUSES else 'online', "uptime": format_uptime(time.time() - (info['create_time'] or time.time())), "restarts": 0 }}
+        for pid in list(self.cache):
+            if pid not in seen: del self.cache[pid]
+        # pm2 jlist spawns Node, so it only runs when a pm2-managed pid went away or on its slow cadence
+        if time.monotonic() - self.pm2_at >= self.pm2_interval or any(a['pid'] and a['pid'] not in seen for a in self.pm2.values()): self._refresh_pm2()
+        by_cpu = sorted(rows, key=lambda pid: (-rows[pid]['cpu'], pid))
+        by_rss = sorted(rows, key=lambda pid: (-rows[pid]['memory'], pid))
+        # Keep earlier picks while they stay within 2N so near-idle processes don't churn the list (and its hash)
+        keep = self.selected & set(by_cpu[:2 * self.top_n] + by_rss[:2 * self.top_n])
+        picked = set(by_cpu[:self.top_n]) | set(by_rss[:self.top_n]) | keep | {{pid for pid, r in rows.items() if r['name'] in self.watch}}
+        out = []
+        for (name, pm_id), app in self.pm2.items():
+            row = rows.get(app['pid']) if app['pid'] else None
+            if row is None: row = {{ "pid": 0, "name": name, "cpu": 0, "memory": 0, "uptime": "0s" }}
+            else: picked.discard(app['pid']); row = dict(row, name=name)
+            out.append(dict(row, pm_id=pm_id, status=app['status'], restarts=app['restarts']))
+        self.selected = picked
+        out += [rows[pid] for pid in picked]
+        running = {{r['name'] for r in out}}
+        out += [{{ "pid": 0, "name": name, "pm_id": -1, "cpu": 0, "memory": 0, "status": 'stopped', "uptime": "0s", "restarts": 0 }} for name in self.watch - running]
+        out.sort(key=lambda r: (r['pm_id'] < 0, r['name'], r['pid']))  # Stable order so processDelta indexes line up
+        return out
+
+processes = ProcessCollector(PROCESS_TOP_N, WATCH_PROCESSES, PM2_INTERVAL, lambda seconds: metrics.observe('pimonitor_pm2_jlist_seconds', (), seconds))
+
 # --- UPDATER SYSTEM ---
 def create_updater_scripts():
     script_b = \"\"\"
-import os, sys, time, shutil, subprocess, signal
+import os, sys, time, shutil, subprocess, signal, json, requests
 
 PID = int(sys.argv[1])
-UPDATE_DIR = sys.argv[2]
+PLAN_FILE = sys.argv[2]
 TARGET_DIR = sys.argv[3]
 PYTHON_EXEC = sys.argv[4]
+PORT = sys.argv[5]
+UPDATE_DIR = os.path.join(TARGET_DIR, "temp_update")
+BACKUP_DIR = os.path.join(TARGET_DIR, "update_backup")
+DIST_DIR = os.path.join(TARGET_DIR, "dist")
+HEALTH_URL = f"http://127.0.0.1:{{PORT}}/api/health"
+HEALTH_TIMEOUT = 90
+READY_FILE = os.path.join(TARGET_DIR, "temp_update_ready")
+STOP_TIMEOUT = 15
+FRONTEND_EXTS = ('.ts', '.tsx', '.js', '.jsx', '.css', '.html', '.json', '.svg')
+GENERATED = ('pimonitor_server.py', os.path.join('data', 'settings.json'))
+npm_cmd = "npm.cmd" if os.name == 'nt' else "npm"
 
-print(f"[B] Killing PID {{PID}}...")
-try:
-    if os.name == 'nt': subprocess.call(['taskkill', '/F', '/PID', str(PID)])
-    else: os.kill(PID, signal.SIGKILL)
-except: pass
-
-time.sleep(2)
-print("[B] Copying...")
-for item in os.listdir(UPDATE_DIR):
-    s, d = os.path.join(UPDATE_DIR, item), os.path.join(TARGET_DIR, item)
+with open(PLAN_FILE) as f: plan = json.load(f)
+changed, full = plan['changed'], plan['mode'] == 'full'
+backed_up = []
+
+def health():
     try:
-        if os.path.isdir(s):
-            if os.path.exists(d): shutil.rmtree(d)
-            shutil.copytree(s, d)
-        else: shutil.copy2(s, d)
-    except: pass
+        r = requests.get(HEALTH_URL, timeout=2)
+        return r.json() if r.status_code == 200 else None
+    except Exception: return None
 
-try: shutil.rmtree(UPDATE_DIR)
-except: pass
+def alive(pid):
+    try: os.kill(pid, 0); return True
+    except OSError: return False
 
-print("[B] Running setup...")
-subprocess.call([PYTHON_EXEC, "setup_server.py"])
+def stop(pid):
+    print(f"[B] Stopping PID {{pid}}...")
+    try:
+        if os.name == 'nt': subprocess.call(['taskkill', '/F', '/PID', str(pid)]); return
+        os.kill(pid, signal.SIGTERM)  # Lets the server flush its journals
+    except OSError: return
+    deadline = time.time() + STOP_TIMEOUT
+    while alive(pid) and time.time() < deadline: time.sleep(0.2)
+    try: os.kill(pid, signal.SIGKILL)
+    except OSError: pass
 
-print("[B] Building...")
-npm_cmd = "npm.cmd" if os.name == 'nt' else "npm"
+def start(takeover=False):
+    print("[B] Starting...")
+    kw = {{'creationflags': subprocess.CREATE_NEW_CONSOLE}} if os.name == 'nt' else {{'start_new_session': True}}
+    env = dict(os.environ, PIMONITOR_TAKEOVER=READY_FILE) if takeover else None
+    return subprocess.Popen([PYTHON_EXEC, "pimonitor_server.py"], cwd=TARGET_DIR, env=env, **kw)
+
+def wait_ready(proc):
+    # The new server touches READY_FILE once its imports and static index are done and it is waiting for the data lock
+    deadline = time.time() + HEALTH_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None: return False
+        if os.path.exists(READY_FILE): return True
+        time.sleep(0.2)
+    return False
+
+def wait_healthy(proc):
+    deadline = time.time() + HEALTH_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None: return False
+        h = health()
+        if h and h.get('pid') == proc.pid: return True
+        time.sleep(0.5)
+    return False
+
+def backup(rel):
+    src, dst = os.path.join(TARGET_DIR, rel), os.path.join(BACKUP_DIR, rel)
+    if os.path.exists(src):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(src, dst)
+    backed_up.append(rel)  # Recorded even when absent so a rollback removes the new file
+
+def rollback():
+    print("[B] Rolling back...")
+    for rel in backed_up:
+        src, dst = os.path.join(BACKUP_DIR, rel), os.path.join(TARGET_DIR, rel)
+        if os.path.exists(src): shutil.copy2(src, dst)
+        elif os.path.exists(dst): os.remove(dst)
+    if os.path.isdir(os.path.join(BACKUP_DIR, 'dist')):
+        shutil.rmtree(DIST_DIR, ignore_errors=True)
+        shutil.copytree(os.path.join(BACKUP_DIR, 'dist'), DIST_DIR)
+
+def apply():
+    for rel in changed + list(GENERATED): backup(rel)
+    print(f"[B] Replacing {{len(changed)}} files...")
+    for rel in changed:
+        dst = os.path.join(TARGET_DIR, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(os.path.join(UPDATE_DIR, rel), dst)
+    if full or 'setup_server.py' in changed or not os.path.exists(os.path.join(TARGET_DIR, 'pimonitor_server.py')):
+        print("[B] Running setup...")
+        subprocess.check_call([PYTHON_EXEC, "setup_server.py"], cwd=TARGET_DIR)
+    if full or {{'package.json', 'package-lock.json'}} & set(changed) or not os.path.isdir(os.path.join(TARGET_DIR, 'node_modules')):
+        print("[B] Installing packages...")
+        subprocess.check_call([npm_cmd, "install"], cwd=TARGET_DIR)
+    if full or any(rel.endswith(FRONTEND_EXTS) for rel in changed) or not os.path.exists(os.path.join(DIST_DIR, 'index.html')):
+        print("[B] Building...")
+        if os.path.isdir(DIST_DIR): shutil.copytree(DIST_DIR, os.path.join(BACKUP_DIR, 'dist'))
+        subprocess.check_call([npm_cmd, "run", "build"], cwd=TARGET_DIR)
+    if plan.get('hash'):
+        settings_file = os.path.join(TARGET_DIR, 'data', 'settings.json')
+        settings = {{}}
+        if os.path.exists(settings_file):
+            with open(settings_file) as f: settings = json.load(f)
+        settings['localHash'] = plan['hash']
+        os.makedirs(os.path.dirname(settings_file), exist_ok=True)
+        with open(settings_file, 'w') as f: json.dump(settings, f, indent=2)
+
+def cleanup(*paths):
+    for p in paths:
+        if os.path.isdir(p): shutil.rmtree(p, ignore_errors=True)
+        elif os.path.exists(p): os.remove(p)
+
+# Servers that report takeover hold a lock on data/: the new one is started first and parks on that lock,
+# so a broken build fails while the old server still serves, and nothing is read until the old one has
+# flushed and exited. Older servers fall back to stop-then-start.
+old = health()
+takeover = bool(old and old.get('takeover'))
+if os.path.exists(BACKUP_DIR): shutil.rmtree(BACKUP_DIR)
 try:
-    subprocess.call([npm_cmd, "install"], cwd=TARGET_DIR)
-    subprocess.call([npm_cmd, "run", "build"], cwd=TARGET_DIR)
-except: pass
+    apply()
+except Exception as e:
+    print(f"[B] Update failed: {{e}}")
+    rollback()
+    cleanup(UPDATE_DIR, PLAN_FILE)
+    sys.exit(1)
 
-print("[B] Starting...")
-subprocess.Popen([PYTHON_EXEC, "pimonitor_server.py"])
+if takeover:
+    if os.path.exists(READY_FILE): os.remove(READY_FILE)
+    proc = start(takeover=True)
+    if not wait_ready(proc): stop(proc.pid); rollback(); ok = False
+    else:
+        stop(PID)
+        ok = wait_healthy(proc)
+        if not ok: stop(proc.pid); rollback(); start()
+else:
+    stop(PID)
+    proc = start()
+    ok = wait_healthy(proc)
+    if not ok: stop(proc.pid); rollback(); start()
+print("[B] Update complete." if ok else "[B] New server failed its health check, rolled back.")
+cleanup(UPDATE_DIR, PLAN_FILE, READY_FILE, *([BACKUP_DIR] if ok else []))
 \"\"\"
     with open("update_script_B.py", "w", encoding="utf-8") as f: f.write(script_b)
 
     script_a = \"\"\"
-import os, sys, subprocess, zipfile, requests, io, shutil
-URL, TOKEN, SERVER_PID = sys.argv[1], sys.argv[2], sys.argv[3]
+import os, sys, subprocess, zipfile, requests, shutil, json, zlib
+URL, TOKEN, SERVER_PID, PORT = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]
+REMOTE_HASH = sys.argv[5] if len(sys.argv) > 5 else ''
+MODE = sys.argv[6] if len(sys.argv) > 6 else 'incremental'
 TARGET_DIR = os.getcwd()
 UPDATE_DIR = os.path.join(TARGET_DIR, "temp_update")
+ARCHIVE = os.path.join(TARGET_DIR, "temp_update.zip")
+PLAN_FILE = os.path.join(TARGET_DIR, "temp_update_plan.json")
+SKIP = ('data', 'dist', 'node_modules', '.git', 'temp_update', 'update_backup')
+CHUNK = 1 << 16
+
+def file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''): crc = zlib.crc32(block, crc)
+    return crc
+
+def unchanged(info, path):
+    return os.path.isfile(path) and os.path.getsize(path) == info.file_size and file_crc(path) == info.CRC
 
 try:
     dl_url = URL
     if "github.com" in URL and not URL.endswith(".zip"): dl_url = URL.rstrip('/') + "/archive/refs/heads/main.zip"
     headers = {{}}
     if TOKEN: headers['Authorization'] = f"token {{TOKEN}}"
-    r = requests.get(dl_url, headers=headers)
-    z = zipfile.ZipFile(io.BytesIO(r.content))
+    with requests.get(dl_url, headers=headers, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        with open(ARCHIVE, 'wb') as f:
+            for block in r.iter_content(CHUNK): f.write(block)
     if os.path.exists(UPDATE_DIR): shutil.rmtree(UPDATE_DIR)
-    os.makedirs(UPDATE_DIR)
-    z.extractall(UPDATE_DIR)
-    
-    extracted = os.listdir(UPDATE_DIR)
-    if len(extracted) == 1 and os.path.isdir(os.path.join(UPDATE_DIR, extracted[0])):
-        root = os.path.join(UPDATE_DIR, extracted[0])
-        for item in os.listdir(root): shutil.move(os.path.join(root, item), UPDATE_DIR)
-        os.rmdir(root)
-        
-    cmd = [sys.executable, "update_script_B.py", SERVER_PID, UPDATE_DIR, TARGET_DIR, sys.executable]
+
+    # Compare each member's size and CRC against the installed file and only extract what differs
+    changed = []
+    with zipfile.ZipFile(ARCHIVE) as z:
+        members = [i for i in z.infolist() if not i.is_dir()]
+        tops = {{i.filename.split('/', 1)[0] for i in members}}
+        prefix = tops.pop() + '/' if len(tops) == 1 and all('/' in i.filename for i in members) else ''
+        for info in members:
+            rel = os.path.normpath(info.filename[len(prefix):])
+            if rel.startswith('..') or os.path.isabs(rel) or rel.split(os.sep, 1)[0] in SKIP: continue
+            if MODE != 'full' and unchanged(info, os.path.join(TARGET_DIR, rel)): continue
+            dst = os.path.join(UPDATE_DIR, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with z.open(info) as src, open(dst, 'wb') as out: shutil.copyfileobj(src, out, CHUNK)
+            changed.append(rel)
+    os.remove(ARCHIVE)
+    print(f"[A] {{len(changed)}} changed files")
+    with open(PLAN_FILE, 'w') as f: json.dump({{'changed': changed, 'mode': MODE, 'hash': REMOTE_HASH}}, f)
+
+    cmd = [sys.executable, "update_script_B.py", SERVER_PID, PLAN_FILE, TARGET_DIR, sys.executable, PORT]
     if os.name == 'nt': subprocess.Popen(cmd, creationflags=subprocess.CREATE_NEW_CONSOLE)
     else: subprocess.Popen(cmd, start_new_session=True)
 except Exception as e: print(e)
@@ -137,7 +1284,9 @@ except Exception as e: print(e)
 
 def monitor_local_system():
     device_id = 'server-local'
+    pm2_procs, procs_at = [], 0
     while True:
+        loop_started = time.perf_counter()
         try:
             cpu_pct = psutil.cpu_percent(interval=None)
             mem = psutil.virtual_memory()
@@ -145,20 +1294,8 @@ def monitor_local_system():
             time.sleep(1)
             net2 = psutil.net_io_counters()
             
-            # PM2
-            pm2_procs = []
-            try:
-                if os.name == 'nt': res = subprocess.check_output(['pm2', 'jlist'], shell=True)
-                else: res = subprocess.check_output(['pm2', 'jlist'])
-                for p in json.loads(res):
-                    pm2_procs.append({{
-                        "pid": p.get("pid"), "name": p.get("name"), "pm_id": p.get("pm_id"),
-                        "status": p.get('pm2_env', {{}}).get('status', 'stopped'),
-                        "cpu": p.get('monit', {{}}).get('cpu', 0),
-                        "memory": round(p.get('monit', {{}}).get('memory', 0)/1024/1024, 1),
-                        "uptime": "0s", "restarts": p.get('pm2_env', {{}}).get('restart_time', 0)
-                    }})
-            except: pass
+            if time.monotonic() - procs_at >= PROCESS_INTERVAL:
+                pm2_procs, procs_at = processes.collect(), time.monotonic()
 
             stats = {{
                 "cpuUsage": cpu_pct, "memoryUsage": mem.percent,
@@ -182,73 +1319,67 @@ def monitor_local_system():
                     except: pass
             except: pass
 
-            now_str = datetime.now().strftime('%H:%M:%S')
-            if device_id not in devices_store:
-                devices_store[device_id] = {{
-                    'id': device_id, 'name': 'Local Server', 'ip': '127.0.0.1', 'os': platform.system(),
-                    'status': 'online', 'lastSeen': time.time(), 'stats': stats, 'processes': pm2_procs, 'hardware': hw,
-                    'history': {{ 'cpu': [], 'memory': [], 'network': [] }}
-                }}
-            else:
-                dev = devices_store[device_id]
-                dev['status'] = 'online'; dev['lastSeen'] = time.time(); dev['stats'] = stats; dev['processes'] = pm2_procs; dev['hardware'] = hw
-                dev['history']['cpu'].append({{ 'time': now_str, 'value': stats.get('cpuUsage', 0) }})
-                dev['history']['memory'].append({{ 'time': now_str, 'value': stats.get('memoryUsage', 0) }})
-                dev['history']['network'].append({{ 'time': now_str, 'value': stats.get('networkIn', 0) }})
-                if len(dev['history']['cpu']) > MAX_HISTORY: 
-                    dev['history']['cpu'] = dev['history']['cpu'][-MAX_HISTORY:]
-                    dev['history']['memory'] = dev['history']['memory'][-MAX_HISTORY:]
-                    dev['history']['network'] = dev['history']['network'][-MAX_HISTORY:]
+            with device_locks(device_id):
+                liveness.set_interval(device_id, 1); liveness.heartbeat(device_id)
+                is_new = device_id not in devices_store
+                if is_new:
+                    devices_store[device_id] = {{
+                        'id': device_id, 'name': 'Local Server', 'ip': '127.0.0.1', 'os': platform.system(),
+                        'status': 'online', 'lastSeen': time.time(), 'stats': stats, 'processes': pm2_procs, 'hardware': hw
+                    }}
+                else:
+                    dev = devices_store[device_id]
+                    dev['status'] = 'online'; dev['lastSeen'] = time.time(); dev['stats'] = stats; dev['processes'] = pm2_procs; dev['hardware'] = hw
+                record_sample(device_id, stats)
+                fleet.update(device_id, stats, len(pm2_procs))
+                publish_device(devices_store[device_id], [(None, stats)], full=is_new)
+                fired = evaluate_alerts(devices_store[device_id], [(None, stats)])
+            raise_alerts(devices_store[device_id], fired)
+            elapsed = time.perf_counter() - loop_started
+            metrics.observe('pimonitor_monitor_loop_seconds', (), elapsed)
+            metrics.gauges['pimonitor_monitor_loop_lag_seconds'] = max(0.0, elapsed - 1)
 
         except Exception as e: print(f"Monitor error: {{e}}"); time.sleep(1)
 
 # --- AUTH ENDPOINTS ---
 @app.route('/api/auth/check', methods=['GET'])
 def check_setup():
-    return jsonify({{'setupRequired': len(load_json(USERS_FILE, [])) == 0}})
+    return jsonify({{'setupRequired': len(users_db) == 0}})
 
 @app.route('/api/auth/setup', methods=['POST'])
 def setup_owner():
-    users = load_json(USERS_FILE, [])
-    if len(users) > 0: return jsonify({{'error': 'Setup already completed'}}), 400
     data = request.json
-    new_user = {{ 'id': str(uuid.uuid4()), 'username': data['username'], 'password': data['password'], 'role': 'Owner', 'joinedAt': datetime.now().isoformat() }}
-    users.append(new_user)
-    save_json(USERS_FILE, users)
+    with users_db.lock:
+        if len(users_db) > 0: return jsonify({{'error': 'Setup already completed'}}), 400
+        new_user = users_db.put({{ 'id': str(uuid.uuid4()), 'username': data['username'], 'password': data['password'], 'role': 'Owner', 'joinedAt': datetime.now().isoformat() }})
     return jsonify(new_user)
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.json
-    user = next((u for u in load_json(USERS_FILE, []) if u['username'] == data.get('username') and u['password'] == data.get('password')), None)
+    user = next((u for u in users_db.find('username', data.get('username')) if u['password'] == data.get('password')), None)
     if user: return jsonify(user)
     return jsonify({{'error': 'Invalid credentials'}}), 401
 
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.json
-    invites = load_json(INVITES_FILE, [])
-    code = data.get('code')
-    valid = next((i for i in invites if i['code'] == code), None)
+    valid = invites_db.get(data.get('code'))
     
     if not valid: return jsonify({{'error': 'Invalid code'}}), 400
     if valid['expiresAt'] < time.time() * 1000: return jsonify({{'error': 'Code expired'}}), 400
     
-    users = load_json(USERS_FILE, [])
-    new_user = {{ 'id': str(uuid.uuid4()), 'username': data['username'], 'password': data['password'], 'role': valid['role'], 'joinedAt': datetime.now().isoformat() }}
-    users.append(new_user)
-    save_json(USERS_FILE, users)
+    new_user = users_db.put({{ 'id': str(uuid.uuid4()), 'username': data['username'], 'password': data['password'], 'role': valid['role'], 'joinedAt': datetime.now().isoformat() }})
     return jsonify(new_user)
 
 # --- USER & INVITE ENDPOINTS ---
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    return jsonify(load_json(USERS_FILE, []))
+    return jsonify(users_db.all())
 
 @app.route('/api/invites', methods=['GET', 'POST'])
 def manage_invites():
-    invites = load_json(INVITES_FILE, [])
-    if request.method == 'GET': return jsonify(invites)
+    if request.method == 'GET': return jsonify(invites_db.all())
     data = request.json
     new_invite = {{ 
         'code': str(uuid.uuid4())[:6].upper(), 
@@ -256,64 +1387,53 @@ def manage_invites():
         'createdBy': data.get('createdBy'),
         'expiresAt': (time.time() + 86400) * 1000 
     }}
-    invites.append(new_invite)
-    save_json(INVITES_FILE, invites)
-    return jsonify(new_invite)
+    return jsonify(invites_db.put(new_invite))
 
 @app.route('/api/invites/<code_id>', methods=['DELETE'])
 def delete_invite(code_id):
-    invites = load_json(INVITES_FILE, [])
-    invites = [i for i in invites if i['code'] != code_id]
-    save_json(INVITES_FILE, invites)
+    invites_db.delete(code_id)
     return jsonify({{'status': 'ok'}})
 
 # --- MAIL & NOTIF ENDPOINTS ---
 @app.route('/api/mail/<user_id>', methods=['GET'])
 def get_mail(user_id):
-    all_mail = load_json(MAIL_FILE, [])
-    return jsonify([m for m in all_mail if m['toId'] == user_id])
+    return jsonify(mail_db.find('toId', user_id))
 
 @app.route('/api/mail', methods=['POST'])
 def send_mail():
     data = request.json
-    all_mail = load_json(MAIL_FILE, [])
     new_mail = {{ 
         'id': str(uuid.uuid4()), 'fromId': data['fromId'], 'toId': data['toId'], 
         'subject': data['subject'], 'body': data['body'], 'read': False, 
         'timestamp': datetime.now().isoformat() 
     }}
-    all_mail.append(new_mail)
-    save_json(MAIL_FILE, all_mail)
-    return jsonify(new_mail)
+    return jsonify(mail_db.put(new_mail))
 
 @app.route('/api/mail/<mail_id>', methods=['DELETE'])
 def delete_mail(mail_id):
-    all_mail = load_json(MAIL_FILE, [])
-    save_json(MAIL_FILE, [m for m in all_mail if m['id'] != mail_id])
+    mail_db.delete(mail_id)
     return jsonify({{'status': 'ok'}})
 
 @app.route('/api/mail/<user_id>/read-all', methods=['PUT'])
 def read_all_mail(user_id):
-    all_mail = load_json(MAIL_FILE, [])
-    for m in all_mail:
-        if m['toId'] == user_id: m['read'] = True
-    save_json(MAIL_FILE, all_mail)
+    with mail_db.lock:
+        for m in mail_db.find('toId', user_id):
+            if not m['read']: mail_db.put(dict(m, read=True))
     return jsonify({{'status': 'ok'}})
 
 @app.route('/api/notifications/<user_id>', methods=['GET'])
 def get_notifs(user_id):
-    return jsonify([n for n in load_json(NOTIF_FILE, []) if n['userId'] == user_id])
+    return jsonify(notifs_db.find('userId', user_id))
 
 @app.route('/api/notifications/<notif_id>', methods=['DELETE'])
 def delete_notif(notif_id):
-    all_n = load_json(NOTIF_FILE, [])
-    save_json(NOTIF_FILE, [n for n in all_n if n['id'] != notif_id])
+    notifs_db.delete(notif_id)
     return jsonify({{'status': 'ok'}})
 
 @app.route('/api/notifications/<user_id>/clear', methods=['DELETE'])
 def clear_notifs(user_id):
-    all_n = load_json(NOTIF_FILE, [])
-    save_json(NOTIF_FILE, [n for n in all_n if n['userId'] != user_id])
+    with notifs_db.lock:
+        for n in notifs_db.find('userId', user_id): notifs_db.delete(n['id'])
     return jsonify({{'status': 'ok'}})
 
 # --- SETTINGS ENDPOINT ---
@@ -326,14 +1446,106 @@ def update_settings():
     return jsonify({{'status': 'ok'}})
 
 # --- DEVICE & TELEMETRY ---
+def liveness_monitor():
+    while True:
+        time.sleep(LIVENESS_TICK)
+        commands.requeue_stale(time.time())
+        for d_id in liveness.expire(time.time()):
+            dev = devices_store.get(d_id)
+            if dev is None: continue
+            with device_locks(d_id):
+                if dev['status'] == 'offline' or liveness.is_online(d_id): continue
+                dev['status'] = 'offline'
+                fleet.remove(d_id)
+                publish_device(dev, [])
+            notify_users(f"Device {{dev['name']}} went offline", 'alert', {{'deviceId': d_id}})
+
+def snapshot_device(d_id):
+    with device_locks(d_id):
+        dev = devices_store[d_id]
+        return dict(dev, processes=[dict(p) for p in dev.get('processes') or []])
+
+def serialize_devices(since=0, fields=None, offset=0, limit=None):
+    results = []
+    ids = [d_id for d_id, dev in list(devices_store.items()) if dev.get('version', 0) > since]
+    for d_id in ids[offset:None if limit is None else offset + limit]:
+        snap = snapshot_device(d_id)
+        if fields: snap = {{k: snap.get(k) for k in fields if k != 'history'}}
+        if not fields or 'history' in fields: snap['history'] = device_history(d_id, devices_store[d_id]['lastSeen'])
+        results.append(snap)
+    return results, len(ids)
+
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
-    results = []
+    since = request.args.get('since', 0, type=int)
+    if request.args.get('epoch') not in (None, DEVICES_EPOCH): since = 0  # Server restarted, versions are meaningless
+    fields = [f for f in request.args.get('fields', '').split(',') if f] or None
+    offset, limit = max(0, request.args.get('offset', 0, type=int)), request.args.get('limit', None, type=int)
+    etag = f"{{DEVICES_EPOCH}}-{{devices_version}}-{{len(devices_store)}}-{{zlib.crc32(request.query_string)}}"
+    headers = {{'ETag': f'"{{etag}}"', 'Cache-Control': 'no-cache', 'X-Devices-Version': str(devices_version), 'X-Devices-Epoch': DEVICES_EPOCH}}
+    if request.if_none_match.contains(etag): return Response(status=304, headers=headers)
+    results, total = serialize_devices(since, fields, offset, limit)
+    headers['X-Total-Count'] = str(total)
+    return json_response(results, headers=headers)
+
+@app.route('/api/fleet/summary', methods=['GET'])
+def fleet_summary():
+    top = min(max(1, request.args.get('top', FLEET_TOP_DEFAULT, type=int)), 100)
+    return jsonify(dict(fleet.summary(top), devices=len(devices_store)))
+
+@app.route('/api/devices/<d_id>/history', methods=['GET'])
+def get_device_history(d_id):
     now = time.time()
-    for _, dev in devices_store.items():
-        if now - dev['lastSeen'] > 15: dev['status'] = 'offline'
-        results.append(dev)
-    return jsonify(results)
+    end = request.args.get('to', now, type=float)
+    start = request.args.get('from', end - 3600, type=float)
+    points = max(3, request.args.get('points', HISTORY_DEFAULT_POINTS, type=int))
+    mode = request.args.get('mode', 'lttb')
+    metrics_requested = [m for m in request.args.get('metric', 'cpu').split(',') if m in TS_METRICS]
+    if not metrics_requested or end <= start: return jsonify({{'error': 'Invalid range or metric'}}), 400
+    tier = next((t for t, (step, slots) in enumerate(TS_TIERS) if now - start <= step * slots and (end - start) / step <= HISTORY_MAX_RAW), len(TS_TIERS) - 1)
+    series = {{}}
+    for metric in metrics_requested:
+        rows = tsdb.query(d_id, metric, start, end, tier)
+        ts, vs, peaks = [r[0] for r in rows], [round(r[1], 2) for r in rows], [round(r[2], 2) for r in rows]
+        idx = minmax_indices(vs, points) if mode == 'minmax' else lttb_indices(ts, vs, points)
+        series[metric] = {{ 't': [ts[i] for i in idx], 'v': [vs[i] for i in idx], 'max': [peaks[i] for i in idx], 'raw': len(rows) }}
+    return json_response({{ 'deviceId': d_id, 'from': start, 'to': end, 'step': TS_TIERS[tier][0], 'series': series }})
+
+# --- STREAM ---
+def stream_snapshot(user_id, role):
+    return {{ 'devices': serialize_devices()[0], 'mails': mail_db.find('toId', user_id), 'notifications': notifs_db.find('userId', user_id),
+              'users': users_db.all(), 'invites': invites_db.all() if role == 'Owner' else [] }}
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    user_id = request.args.get('userId')
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({{'error': 'Too many streams, poll instead'}}), 503  # The dashboard falls back to polling
+    def generate():
+        cursor = change_feed.seq
+        role = (users_db.get(user_id) or {{}}).get('role')
+        yield sse('snapshot', stream_snapshot(user_id, role))
+        while True:
+            events, latest = change_feed.wait(cursor, STREAM_KEEPALIVE)
+            if events and events[0][0] > cursor + 1: yield sse('snapshot', stream_snapshot(user_id, role))  # Fell behind the feed
+            elif not events: yield ": keepalive\\n\\n"
+            else:
+                audience = (None, user_id, f"role:{{role}}")
+                for _, _, frame, owner in events:
+                    if owner in audience: yield frame
+            cursor = latest
+    resp = Response(generate(), mimetype='text/event-stream', headers={{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}})
+    resp.call_on_close(stream_slots.release)
+    return resp
+
+@app.route('/api/alerts/rules', methods=['GET', 'PUT'])
+def alert_rules():
+    if request.method == 'GET': return jsonify(alerts.rules)
+    rules = request.json
+    try: alerts.load(rules)
+    except (KeyError, ValueError, TypeError) as e: return jsonify({{'error': f'Invalid rule: {{e}}'}}), 400
+    save_json(ALERT_RULES_FILE, rules)
+    return jsonify({{'status': 'ok'}})
 
 @app.route('/api/devices/power', methods=['POST'])
 def device_power_action():
@@ -341,43 +1553,214 @@ def device_power_action():
     d_id = data.get('deviceId')
     action = data.get('action')
     if d_id and action in ['reboot', 'shutdown']:
-        pending_commands[d_id] = action
-        return jsonify({{'status': 'queued'}})
+        return jsonify({{'status': 'queued', 'commandId': commands.enqueue(d_id, action)['id']}})
     return jsonify({{'error': 'Invalid'}}), 400
 
+@app.route('/api/devices/commands', methods=['POST'])
+def queue_commands():
+    data = request.json
+    ids = list(devices_store) if data.get('deviceIds') == '*' else (data.get('deviceIds') or ([data['deviceId']] if data.get('deviceId') else []))
+    action = data.get('action')
+    if not ids or action not in COMMAND_ACTIONS: return jsonify({{'error': 'Invalid'}}), 400
+    return jsonify({{'status': 'queued', 'commands': [commands.enqueue(d_id, action, data.get('args')) for d_id in ids]}})
+
+@app.route('/api/devices/<d_id>/commands', methods=['GET'])
+def poll_commands(d_id):
+    wait = min(request.args.get('wait', 0, type=float), COMMAND_POLL_TIMEOUT)
+    if wait <= 0: return jsonify({{'commands': commands.take(d_id)}})
+    if not long_poll_slots.acquire(blocking=False):
+        # Out of long-poll slots: answer now and let the agent back off; its telemetry responses still carry commands
+        return jsonify({{'commands': commands.take(d_id), 'retryAfter': COMMAND_POLL_TIMEOUT}})
+    try: return jsonify({{'commands': commands.take(d_id, wait)}})
+    finally: long_poll_slots.release()
+
+@app.route('/api/commands/<cmd_id>', methods=['GET'])
+def get_command(cmd_id):
+    cmd = commands.get(cmd_id)
+    if cmd is None: return jsonify({{'error': 'Unknown command'}}), 404
+    return jsonify(cmd)
+
+@app.route('/api/commands/<cmd_id>/ack', methods=['POST'])
+def ack_command(cmd_id):
+    data = request.json or {{}}
+    cmd = commands.ack(cmd_id, data.get('status', 'done'), data.get('result'))
+    if cmd is None: return jsonify({{'error': 'Unknown command'}}), 404
+    return jsonify(cmd)
+
+def rollout_worker():
+    while True:
+        time.sleep(ROLLOUT_TICK)
+        try: rollouts.tick(time.time())
+        except Exception as e: print(f"Rollout error: {{e}}")
+
+@app.route('/api/releases', methods=['POST'])
+def fetch_release():
+    try: release = releases.fetch(server_settings.get('repoUrl', ''), server_settings.get('githubToken', ''), update_cache.get('remote_hash'))
+    except Exception as e: return jsonify({{'error': str(e)}}), 502
+    return jsonify(release)
+
+@app.route('/api/releases/<digest>', methods=['GET'])
+def serve_release(digest):
+    if releases.get(digest) is None: return jsonify({{'error': 'Unknown release'}}), 404
+    # Content-addressed, so the digest is the ETag and the bundle never changes; send_file handles Range/If-Range
+    return send_file(releases.path(digest), mimetype='application/zip', conditional=True, etag=digest, max_age=31536000)
+
+@app.route('/api/rollouts', methods=['GET', 'POST'])
+def manage_rollouts():
+    if request.method == 'GET': return jsonify(rollouts.all())
+    data = request.json or {{}}
+    ids = [d for d in devices_store if d != 'server-local'] if data.get('deviceIds') == '*' else [d for d in data.get('deviceIds') or [] if d in devices_store]
+    if not ids: return jsonify({{'error': 'No devices'}}), 400
+    if not server_settings.get('repoUrl'): return jsonify({{'error': 'No repo'}}), 400
+    try: return jsonify(rollouts.create(ids, data))
+    except (TypeError, ValueError) as e: return jsonify({{'error': f'Invalid options: {{e}}'}}), 400
+
+@app.route('/api/rollouts/<r_id>', methods=['GET'])
+def get_rollout(r_id):
+    rollout = rollouts.get(r_id)
+    if rollout is None: return jsonify({{'error': 'Unknown rollout'}}), 404
+    return jsonify(rollout)
+
+@app.route('/api/rollouts/<r_id>/<action>', methods=['POST'])
+def control_rollout(r_id, action):
+    if action not in ('pause', 'resume', 'cancel'): return jsonify({{'error': 'Invalid'}}), 400
+    rollout = rollouts.control(r_id, action)
+    if rollout is None: return jsonify({{'error': 'Unknown rollout'}}), 404
+    return jsonify(rollout)
+
+@app.route('/api/devices/update', methods=['POST'])
+def update_device():
+    d_id = (request.json or {{}}).get('deviceId')
+    if d_id not in devices_store: return jsonify({{'error': 'Unknown device'}}), 404
+    if not server_settings.get('repoUrl'): return jsonify({{'error': 'No repo'}}), 400
+    return jsonify(rollouts.create([d_id], {{}}))
+
+def ingest_telemetry(data, samples, remote_addr):
+    d_id = data.get('id')
+    resp = {{'status': 'success'}}
+    samples = correct_clock(d_id, data, samples)
+    
+    if data.get('backfill'):  # Spooled samples from a reconnecting agent: history only, live state is left alone
+        with device_locks(d_id):
+            for ts, sample in sorted(samples or [], key=lambda s: s[0]): record_sample(d_id, sample, ts)
+            if d_id in devices_store: touch_device(devices_store[d_id])
+        return resp
+
+    if data.get('commandsInResponse'): resp['commands'] = commands.take(d_id)  # Delivery no longer depends on a long-poll slot
+    elif not data.get('commandChannel'):  # Agents without the long-poll channel get one command per post
+        for cmd in commands.take(d_id, limit=1):
+            resp['command'] = cmd['action']
+            commands.ack(cmd['id'], 'delivered')  # These agents never ack, so don't requeue (and repeat) the action
+    
+    stats = samples[-1][1] if samples else (data.get('stats') or {{}})
+    samples = samples or [(None, stats)]
+    with device_locks(d_id):
+        is_new = d_id not in devices_store
+        if is_new:
+            devices_store[d_id] = {{ 'id': d_id, 'name': data.get('name', d_id), 'ip': remote_addr, 'os': data.get('os', 'Unknown'), 'status': 'online', 'lastSeen': time.time(), 'stats': stats, 'processes': [], 'hardware': {{}} }}
+        dev = devices_store[d_id]
+        if data.get('heartbeatInterval'): liveness.set_interval(d_id, data['heartbeatInterval'])
+        liveness.heartbeat(d_id)
+        recovered = dev['status'] == 'offline'
+        dev['status'] = 'online'; dev['lastSeen'] = time.time(); dev['stats'] = stats
+        if data.get('agentVersion'): dev['agentVersion'] = data['agentVersion']
+        if data.get('relay'): dev['relay'] = data['relay']
+        need = apply_delta(d_id, dev, data)
+        if need: resp['need'] = need
+        for ts, sample in samples: record_sample(d_id, sample, ts)
+        fleet.update(d_id, stats, len(dev.get('processes') or []))
+        publish_device(dev, samples, full=is_new or 'hardware' in data)
+        fired = evaluate_alerts(dev, samples)
+    raise_alerts(dev, fired)
+    if recovered: notify_users(f"Device {{dev['name']}} is back online", 'info', {{'deviceId': d_id}})
+    return resp
+
+def count_ingest(kind, samples):
+    labels = (('format', kind),)
+    metrics.inc('pimonitor_telemetry_requests_total', labels)
+    metrics.inc('pimonitor_telemetry_samples_total', labels, samples)
+    metrics.inc('pimonitor_telemetry_payload_bytes_total', labels, request.content_length or 0)
+
 @app.route('/api/telemetry', methods=['GET', 'POST'])
 def receive_telemetry():
     if request.method == 'GET': return jsonify({{'status': 'active'}})
-    try:
-        data = request.json
-        d_id = data.get('id')
-        resp = {{'status': 'success'}}
-        
-        if d_id in pending_commands:
-            resp['command'] = pending_commands[d_id]
-            del pending_commands[d_id]
-        
-        if d_id in pending_updates:
-            resp['command'] = 'update'
-            resp['repoUrl'] = pending_updates[d_id]['url']
-            resp['token'] = pending_updates[d_id]['token']
-            del pending_updates[d_id]
-
-        if d_id not in devices_store:
-            devices_store[d_id] = {{ 'id': d_id, 'name': data.get('name', d_id), 'ip': request.remote_addr, 'os': data.get('os', 'Unknown'), 'status': 'online', 'lastSeen': time.time(), 'stats': data.get('stats', {{}}), 'processes': data.get('processes', []), 'hardware': data.get('hardware', {{}}), 'history': {{ 'cpu': [], 'memory': [], 'network': [] }} }}
-        else:
-            dev = devices_store[d_id]
-            dev['status'] = 'online'; dev['lastSeen'] = time.time(); dev['stats'] = data.get('stats'); dev['processes'] = data.get('processes'); dev['hardware'] = data.get('hardware')
-            now = datetime.now().strftime('%H:%M:%S')
-            dev['history']['cpu'].append({{ 'time': now, 'value': data['stats'].get('cpuUsage', 0) }})
-            dev['history']['memory'].append({{ 'time': now, 'value': data['stats'].get('memoryUsage', 0) }})
-            if len(dev['history']['cpu']) > MAX_HISTORY:
-                 dev['history']['cpu'] = dev['history']['cpu'][-MAX_HISTORY:]
-                 dev['history']['memory'] = dev['history']['memory'][-MAX_HISTORY:]
-
-        return jsonify(resp)
+    count_ingest('json', 1)
+    try: return jsonify(ingest_telemetry(request.json, None, request.remote_addr))
+    except Exception as e: return jsonify({{'error': str(e)}}), 500
+
+@app.route('/api/telemetry/batch', methods=['POST'])
+def receive_telemetry_batch():
+    try: meta, samples = decode_batch(request.get_data())
+    except BatchTooLarge as e: return jsonify({{'error': str(e)}}), 413
+    except Exception as e: return jsonify({{'error': str(e)}}), 400
+    count_ingest('backfill' if meta.get('backfill') else 'batch', len(samples))
+    try: return jsonify(ingest_telemetry(meta, samples, request.remote_addr))
     except Exception as e: return jsonify({{'error': str(e)}}), 500
 
+@app.route('/api/telemetry/relay', methods=['POST'])
+def receive_telemetry_relay():
+    try: sections = decode_relay(request.get_data())
+    except BatchTooLarge as e: return jsonify({{'error': str(e)}}), 413
+    except Exception as e: return jsonify({{'error': str(e)}}), 400
+    count_ingest('relay', sum(len(samples) for _, samples in sections))
+    results = {{}}
+    for meta, samples in sections:
+        d_id = meta.get('id')
+        try: resp = ingest_telemetry(meta, samples, meta.get('ip') or request.remote_addr)
+        except Exception as e:
+            if not meta.get('backfill'): results[d_id] = {{'error': str(e)}}
+            continue
+        if meta.get('backfill'): continue  # History only; the device's live section carries need and commands
+        # Relays queue commands for their agents' long-polls, so everything pending goes back with the batch
+        resp['commands'] = commands.take(d_id)
+        results[d_id] = resp
+    return json_response({{'status': 'success', 'devices': results}})
+
+# --- METRICS ENDPOINT ---
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('pimonitor_http_request_duration_seconds', (('route', route), ('method', request.method), ('status', str(response.status_code))), time.perf_counter() - started)
+    return response
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    escape = lambda v: str(v).replace('\\\\', '\\\\\\\\').replace('"', '\\\\"')
+    return '{{' + ','.join(f'{{k}}="{{escape(v)}}"' for k, v in pairs) + '}}'
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    counters, hists = metrics.collect()
+    gauges = dict(metrics.gauges)
+    gauges['pimonitor_devices'] = len(devices_store)
+    gauges['pimonitor_devices_online'] = len(liveness.deadlines)
+    gauges['pimonitor_history_segments'] = len(tsdb.segments)
+    gauges['pimonitor_history_bytes'] = len(tsdb.segments) * tsdb.size
+    gauges['pimonitor_change_feed_events'] = len(change_feed.events)
+    gauges['pimonitor_journal_pending'] = sum(len(c.pending) for c in COLLECTIONS)
+    series = {{}}
+    for (name, labels), v in counters.items(): series.setdefault(name, []).append(f"{{name}}{{format_labels(labels)}} {{v}}")
+    for name, v in gauges.items(): series.setdefault(name, []).append(f"{{name}} {{v}}")
+    for (name, labels), h in hists.items():
+        lines, cumulative = series.setdefault(name, []), 0
+        for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), h):
+            cumulative += n
+            lines.append(f"{{name}}_bucket{{format_labels(labels, [('le', bound)])}} {{cumulative}}")
+        lines.append(f"{{name}}_sum{{format_labels(labels)}} {{h[-1]}}")
+        lines.append(f"{{name}}_count{{format_labels(labels)}} {{cumulative}}")
+    out = []
+    for name in sorted(series):
+        kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+        out += [f"# HELP {{name}} {{help_text}}", f"# TYPE {{name}} {{kind}}"] + series[name]
+    return Response('\\n'.join(out) + '\\n', mimetype='text/plain; version=0.0.4')
+
 # --- UPDATE ---
 @app.route('/api/update/check', methods=['GET'])
 def check_update():
@@ -405,9 +1788,16 @@ def check_update():
 @app.route('/api/update/execute', methods=['POST'])
 def execute_update():
     if not server_settings.get('repoUrl'): return jsonify({{"error": "No repo"}}), 400
+    mode = 'full' if (request.get_json(silent=True) or {{}}).get('mode') == 'full' else 'incremental'
     create_updater_scripts()
-    threading.Thread(target=lambda: (time.sleep(1), subprocess.Popen([sys.executable, "update_script_A.py", server_settings.get('repoUrl'), server_settings.get('githubToken', ''), str(os.getpid())]))).start()
-    return jsonify({{"status": "Update started"}})
+    update_cache['status'] = 'updating'
+    args = [sys.executable, "update_script_A.py", server_settings.get('repoUrl'), server_settings.get('githubToken', ''), str(os.getpid()), str(PORT), update_cache.get('remote_hash') or '', mode]
+    threading.Thread(target=lambda: (time.sleep(1), subprocess.Popen(args, cwd=BASE_DIR))).start()
+    return jsonify({{"status": "Update started", "mode": mode}})
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    return jsonify({{'status': 'ok', 'pid': os.getpid(), 'version': server_settings.get('localHash'), 'uptime': round(time.time() - STARTED_AT, 1), 'takeover': True}})
 
 @app.route('/api/system/power', methods=['POST'])
 def power_ops():
@@ -415,27 +1805,45 @@ def power_ops():
 
 @app.route('/')
 def serve_index():
-    if os.path.exists(os.path.join(DIST_DIR, 'index.html')): return send_from_directory(DIST_DIR, 'index.html')
-    return "PiMonitor Server Running. Build frontend.", 200
+    if not static_files.files and os.path.exists(os.path.join(DIST_DIR, 'index.html')): static_files.load()  # Built after startup
+    return static_files.response('index.html') or ("PiMonitor Server Running. Build frontend.", 200)
 
 @app.route('/<path:path>')
 def serve_static(path):
-    if os.path.exists(os.path.join(DIST_DIR, path)): return send_from_directory(DIST_DIR, path)
+    resp = static_files.response(path)
+    if resp is not None: return resp
+    # Only extensionless paths are client-side routes; missing files and API paths are real 404s
+    if path.startswith(('api/', 'assets/')) or '.' in path.rsplit('/', 1)[-1]: return jsonify({{'error': 'Not found'}}), 404
     return serve_index()
 
 if __name__ == '__main__':
     ensure_data_dir()
+    print(f"Loaded {{tsdb.load()}} history segments")
+    print(f"Indexed {{len(static_files.files)}} static files" + ("" if brotli else " (install brotli for br variants)"))
     ips = ['127.0.0.1']
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.connect(('10.255.255.255', 1)); ips.append(s.getsockname()[0]); s.close()
     except: pass
     print(f"Server on {{PORT}} | IPs: {{', '.join(ips)}}")
     threading.Thread(target=monitor_local_system, daemon=True).start()
-    app.run(host='0.0.0.0', port=PORT)
+    threading.Thread(target=journal_flusher, daemon=True).start()
+    threading.Thread(target=liveness_monitor, daemon=True).start()
+    threading.Thread(target=rollout_worker, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Graceful stop from the updater runs the atexit journal flush
+    try: from waitress import serve
+    except ImportError: serve = None
+    if serve:
+        print(f"Serving with waitress ({{SERVER_THREADS}} threads, instant commands for {{LONG_POLL_SLOTS}} agents, {{STREAM_SLOTS}} dashboard streams)")
+        serve(app, host='0.0.0.0', port=PORT, threads=SERVER_THREADS, connection_limit=max(1000, SERVER_THREADS * 4), channel_timeout=60)
+    else:
+        print("WARNING: waitress is not installed. Falling back to Flask's development server, which is NOT a production server")
+        print("(no thread pool sizing, no connection limits). Install it with: pip install waitress brotli")
+        app.run(host='0.0.0.0', port=PORT, threaded=True)
 """
     with open("pimonitor_server.py", "w", encoding="utf-8") as f: f.write(code)
     return "pimonitor_server.py"
 
 if __name__ == "__main__":
+    install_dependencies()
     generate_server_script(3000)
     print("Done")
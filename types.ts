@@ -1,8 +1,8 @@
 
 export interface PM2Process {
-  pid: number;
+  pid: number; // 0 when a pm2 app or watched process is not running
   name: string;
-  pm_id: number;
+  pm_id: number; // -1 for processes not managed by pm2
   status: 'online' | 'stopped' | 'errored' | 'launching';
   cpu: number;
   memory: number; // in MB
@@ -74,6 +74,54 @@ export interface Device {
   resourceLimits?: ResourceLimits;
   updateAvailable?: boolean; // New field
   version?: string; // New field
+  agentVersion?: string; // Digest of the installed agent bundle
+  relay?: string; // Hostname of the site relay this device reports through
+}
+
+// Partial device pushed over /api/stream; points are [epochSeconds, cpu, memory, networkIn]
+export interface DeviceUpdate extends Partial<Omit<Device, 'history'>> {
+  id: string;
+  points?: Array<[number, number, number, number]>;
+}
+
+export interface StreamSnapshot {
+  devices: Device[];
+  mails: Mail[];
+  notifications: Notification[];
+  users: User[];
+  invites: InviteCode[]; // Only filled for Owner sessions
+}
+
+// Columnar, server-downsampled history from /api/devices/<id>/history; t is epoch seconds
+export interface HistorySeries {
+  t: number[];
+  v: number[];
+  max: number[];
+  raw: number;
+}
+
+export interface DeviceHistory {
+  deviceId: string;
+  from: number;
+  to: number;
+  step: number;
+  series: Record<string, HistorySeries>;
+}
+
+export interface FleetTopEntry {
+  id: string;
+  name: string;
+  value: number;
+}
+
+export interface FleetSummary {
+  devices: number;
+  online: number;
+  cpu: { mean: number; max: number };
+  memory: { mean: number; max: number };
+  network: { in: number; out: number };
+  processes: number;
+  top: Record<'cpu' | 'memory' | 'disk', FleetTopEntry[]>;
 }
 
 export interface WidgetConfig {
@@ -161,3 +209,36 @@ export interface UpdateConfig {
   githubToken?: string;
   changedFiles?: string[]; // New field for listing specific changes
 }
+
+// Staged agent update from /api/rollouts; waves advance once every device reports the release digest as agentVersion
+export interface AgentRelease {
+  digest: string;
+  size: number;
+  commit?: string;
+  fetchedAt: number;
+}
+
+export interface RolloutDevice {
+  state: 'pending' | 'sent' | 'acked' | 'healthy' | 'failed' | 'skipped';
+  commandId?: string;
+  since?: number;
+  error?: string;
+}
+
+export interface Rollout {
+  id: string;
+  status: 'fetching' | 'running' | 'paused' | 'done' | 'failed' | 'cancelled';
+  release?: AgentRelease;
+  error?: string;
+  wave: number;
+  waves: string[][];
+  canary: number;
+  waveSize: number;
+  maxConcurrent: number;
+  healthTimeout: number;
+  maxFailures: number;
+  devices: Record<string, RolloutDevice>;
+  createdAt: number;
+}
+
+export type RolloutOptions = Partial<Pick<Rollout, 'canary' | 'waveSize' | 'maxConcurrent' | 'healthTimeout' | 'maxFailures'>>;